@@ -0,0 +1,430 @@
+# -*- coding: utf-8 -*-
+""""
+/***************************************************************************
+    BezierEditing
+     --------------------------------------
+    Date                 : 01 05 2019
+    Copyright            : (C) 2019 Takayuki Mizutani
+    Email                : mizutani at ecoris dot co dot jp
+ ***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from qgis.PyQt.QtCore import *
+from qgis.PyQt.QtGui import *
+from qgis.core import *
+import base64
+
+from .BezierGeometry import BezierGeometry
+
+
+def geometryClass(interpolation, tolerance, transformContext=None):
+    """
+    BezierGeometry with interpolation settings and transform context of the algorithm.
+    settings of the editing tool aren't changed, so algorithms can run in other threads.
+    transformContext is of the processing context, because the project isn't thread safe.
+    """
+    return type("BezierGeometry", (BezierGeometry,), {
+        "INTERPOLATION": interpolation,
+        "INTERPOLATION_TOLERANCE": tolerance,
+        "TRANSFORM_CONTEXT": transformContext,
+    })
+
+
+def ringsOf(geom):
+    """
+    return lines of geometry as list of parts, which is list of rings.
+    a part of line has one ring.
+    """
+    if geom.type() == QgsWkbTypes.LineGeometry:
+        if geom.isMultipart():
+            return [[line] for line in geom.asMultiPolyline()]
+        return [[geom.asPolyline()]]
+    if geom.isMultipart():
+        return geom.asMultiPolygon()
+    return [geom.asPolygon()]
+
+
+def geometryOf(parts, geom_type, multi):
+    """
+    inverse of ringsOf
+    """
+    if geom_type == QgsWkbTypes.LineGeometry:
+        if multi:
+            return QgsGeometry.fromMultiPolylineXY([rings[0] for rings in parts])
+        return QgsGeometry.fromPolylineXY(parts[0][0])
+    if multi:
+        return QgsGeometry.fromMultiPolygonXY(parts)
+    return QgsGeometry.fromPolygonXY(parts[0])
+
+
+def bezierFields(fields, save_control):
+    """
+    return fields with the field saving interpolation counts, and the field saving anchors and handles if it is set.
+    """
+    fields = QgsFields(fields)
+    names = [BezierGeometry.SEGMENTS_FIELD]
+    if save_control:
+        names.append(BezierGeometry.CONTROL_FIELD)
+    for name in names:
+        if fields.indexOf(name) == -1:
+            fields.append(QgsField(name, QVariant.String))
+    return fields
+
+
+class BezierAlgorithmMixin:
+    """
+    common definitions of bezier editing algorithms
+    """
+
+    def tr(self, message):
+        return QCoreApplication.translate("BezierEditing", message)
+
+    def createInstance(self):
+        return type(self)()
+
+    def group(self):
+        return self.tr("Bezier Editing")
+
+    def groupId(self):
+        return "bezierediting"
+
+    def icon(self):
+        return QIcon(":/plugins/BezierEditing/icon/beziericon.svg")
+
+    def bezierOf(self, cls, crs, feature, ring, single):
+        """
+        return bezier line of the ring, or None if the ring isn't bezier.
+        saved anchors, handles and interpolation counts are used only for single part geometry.
+        """
+        if single:
+            bg = cls.convertFeatureControlToBezier(crs, feature)
+            if bg is not None:
+                return bg
+        counts = cls.featureSegmentCounts(feature) if single else None
+        if not cls.checkIsBezier(crs, ring, counts):
+            return None
+        return cls.convertLineToBezier(crs, ring, counts=counts)
+
+    def setBezierAttributes(self, feature, fields, geom, bgs, layer_type):
+        """
+        set interpolation counts and anchors and handles of single part geometry to the output feature.
+        the fields are set to NULL for multi part geometry.
+        """
+        attributes = feature.attributes()
+        attributes += [NULL] * (fields.count() - len(attributes))
+        segments_idx = fields.indexOf(BezierGeometry.SEGMENTS_FIELD)
+        control_idx = fields.indexOf(BezierGeometry.CONTROL_FIELD)
+        if len(bgs) == 1 and bgs[0] is not None:
+            control = bgs[0].controlPoints(layer_type)
+            # truncated text isn't saved
+            text = BezierGeometry.encodeSegmentCounts(control[2], BezierGeometry.geometryHash(geom))
+            attributes[segments_idx] = text if BezierGeometry.fitsField(fields.at(segments_idx), text) else NULL
+            if control_idx != -1:
+                blob = bgs[0].packControlPoints(control, BezierGeometry.geometryHash(geom))
+                text = base64.b64encode(blob).decode("ascii")
+                attributes[control_idx] = text if BezierGeometry.fitsField(fields.at(control_idx), text) else NULL
+        else:
+            attributes[segments_idx] = NULL
+            if control_idx != -1:
+                attributes[control_idx] = NULL
+        feature.setAttributes(attributes)
+
+
+class ConvertToBezierAlgorithm(BezierAlgorithmMixin, QgsProcessingAlgorithm):
+    """
+    convert lines and polygon rings to bezier lines by fitting curve or as line segments
+    """
+    INPUT = "INPUT"
+    MODE = "MODE"
+    SCALE = "SCALE"
+    INTERPOLATION = "INTERPOLATION"
+    TOLERANCE = "TOLERANCE"
+    WORKERS = "WORKERS"
+    SAVE_CONTROL = "SAVE_CONTROL"
+    OUTPUT = "OUTPUT"
+    CHUNK_FEATURES = 1000  # features converted at once
+
+    def name(self):
+        return "converttobezier"
+
+    def displayName(self):
+        return self.tr("Convert to Bezier")
+
+    def shortHelpString(self):
+        return self.tr("Converts lines and polygon rings to Bezier curves, by fitting curve or as line segments. "
+                       "Output geometries are the interpolated Bezier curves which can be edited by Bezier Editing tool.\n"
+                       "Fitting scale is the map scale of freehand drawing. Larger scale fits fewer anchors.\n"
+                       "Fitting runs in parallel processes if python is the executable of multiprocessing, "
+                       "otherwise in one process. 0 workers uses all CPUs.")
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(QgsProcessingParameterFeatureSource(
+            self.INPUT, self.tr("Input layer"),
+            [QgsProcessing.TypeVectorLine, QgsProcessing.TypeVectorPolygon]))
+        self.addParameter(QgsProcessingParameterEnum(
+            self.MODE, self.tr("Conversion mode"),
+            [self.tr("Fitting curve"), self.tr("Line segments")], defaultValue=0))
+        self.addParameter(QgsProcessingParameterNumber(
+            self.SCALE, self.tr("Fitting scale"), QgsProcessingParameterNumber.Double,
+            defaultValue=1.0, minValue=0.000001))
+        self.addParameter(QgsProcessingParameterNumber(
+            self.INTERPOLATION, self.tr("Interpolation count"), QgsProcessingParameterNumber.Integer,
+            defaultValue=BezierGeometry.INTERPOLATION, minValue=BezierGeometry.MIN_INTERPOLATION,
+            maxValue=BezierGeometry.MAX_INTERPOLATION))
+        self.addParameter(QgsProcessingParameterNumber(
+            self.TOLERANCE, self.tr("Interpolation tolerance in meters (0 uses fixed count)"),
+            QgsProcessingParameterNumber.Double, defaultValue=BezierGeometry.INTERPOLATION_TOLERANCE, minValue=0.0))
+        self.addParameter(QgsProcessingParameterNumber(
+            self.WORKERS, self.tr("Worker processes"), QgsProcessingParameterNumber.Integer,
+            defaultValue=0, minValue=0))
+        self.addParameter(QgsProcessingParameterBoolean(
+            self.SAVE_CONTROL, self.tr("Save anchors and handles"), defaultValue=False))
+        self.addParameter(QgsProcessingParameterFeatureSink(
+            self.OUTPUT, self.tr("Bezier")))
+
+    def processAlgorithm(self, parameters, context, feedback):
+        source = self.parameterAsSource(parameters, self.INPUT, context)
+        if source is None:
+            raise QgsProcessingException(self.invalidSourceError(parameters, self.INPUT))
+        curve = self.parameterAsEnum(parameters, self.MODE, context) == 0
+        scale = self.parameterAsDouble(parameters, self.SCALE, context)
+        cls = geometryClass(self.parameterAsInt(parameters, self.INTERPOLATION, context),
+                            self.parameterAsDouble(parameters, self.TOLERANCE, context), context.transformContext())
+        workers = self.parameterAsInt(parameters, self.WORKERS, context) or None
+        fields = bezierFields(source.fields(), self.parameterAsBool(parameters, self.SAVE_CONTROL, context))
+        wkb_type = QgsWkbTypes.flatType(source.wkbType())
+        sink, dest_id = self.parameterAsSink(parameters, self.OUTPUT, context, fields, wkb_type, source.sourceCrs())
+        if sink is None:
+            raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT))
+
+        crs = source.sourceCrs()
+        layer_type = QgsWkbTypes.geometryType(wkb_type)
+        multi = QgsWkbTypes.isMultiType(wkb_type)
+        total = source.featureCount()
+        done = 0
+        chunk = []
+        features = source.getFeatures()
+        while True:
+            feature = next(features, None)
+            if feature is not None:
+                chunk.append(QgsFeature(feature))
+                if len(chunk) < self.CHUNK_FEATURES:
+                    continue
+            if feedback.isCanceled():
+                break
+            if not self.convertChunk(chunk, cls, crs, curve, scale, workers, layer_type, multi, fields, sink,
+                                     feedback):
+                break
+            done += len(chunk)
+            chunk = []
+            if total > 0:
+                feedback.setProgress(100.0 * done / total)
+            if feature is None:
+                break
+
+        return {self.OUTPUT: dest_id}
+
+    def convertChunk(self, chunk, cls, crs, curve, scale, workers, layer_type, multi, fields, sink, feedback):
+        # rings of all features in the chunk are converted at once
+        structures = []
+        lines = []
+        for feature in chunk:
+            geom = feature.geometry()
+            if geom.isNull() or geom.isEmpty():
+                structures.append(None)
+                continue
+            parts = ringsOf(geom)
+            structures.append(parts)
+            lines.extend(ring for rings in parts for ring in rings if len(ring) >= 2)
+        if curve:
+            bgs = cls.convertLinesToBezier(crs, lines, scale, workers, isCanceled=feedback.isCanceled)
+            if bgs is None:
+                return False
+        else:
+            bgs = [cls.convertLineToBezier(crs, line, "line") for line in lines]
+        bgs = iter(bgs)
+
+        for feature, parts in zip(chunk, structures):
+            if parts is not None:
+                converted = []
+                out_parts = []
+                for rings in parts:
+                    out_rings = []
+                    for ring in rings:
+                        bg = next(bgs) if len(ring) >= 2 else None
+                        converted.append(bg)
+                        out_rings.append(ring if bg is None else bg.getPointList(revert=True))
+                    out_parts.append(out_rings)
+                geom = geometryOf(out_parts, layer_type, multi)
+                feature.setGeometry(geom)
+                self.setBezierAttributes(feature, fields, geom, converted, layer_type)
+            else:
+                self.setBezierAttributes(feature, fields, None, [], layer_type)
+            feature.setFields(fields, False)
+            sink.addFeature(feature, QgsFeatureSink.FastInsert)
+        return True
+
+
+class DensifyAsBezierAlgorithm(BezierAlgorithmMixin, QgsProcessingFeatureBasedAlgorithm):
+    """
+    interpolate bezier lines again with other interpolation settings
+    """
+    SOURCE_INTERPOLATION = "SOURCE_INTERPOLATION"
+    INTERPOLATION = "INTERPOLATION"
+    TOLERANCE = "TOLERANCE"
+    SAVE_CONTROL = "SAVE_CONTROL"
+
+    def name(self):
+        return "densifyasbezier"
+
+    def displayName(self):
+        return self.tr("Densify as Bezier")
+
+    def outputName(self):
+        return self.tr("Densified")
+
+    def shortHelpString(self):
+        return self.tr("Interpolates Bezier curves again with a new interpolation count or tolerance. "
+                       "Saved interpolation counts and anchors are used if the features have them, "
+                       "otherwise the interpolation count of input is used to read the curves.\n"
+                       "Features which aren't Bezier curves are copied as they are.")
+
+    def inputLayerTypes(self):
+        return [QgsProcessing.TypeVectorLine, QgsProcessing.TypeVectorPolygon]
+
+    def supportInPlaceEdit(self, layer):
+        return False
+
+    def initParameters(self, config=None):
+        self.addParameter(QgsProcessingParameterNumber(
+            self.SOURCE_INTERPOLATION, self.tr("Interpolation count of input"), QgsProcessingParameterNumber.Integer,
+            defaultValue=BezierGeometry.INTERPOLATION, minValue=BezierGeometry.MIN_INTERPOLATION,
+            maxValue=BezierGeometry.MAX_INTERPOLATION))
+        self.addParameter(QgsProcessingParameterNumber(
+            self.INTERPOLATION, self.tr("Interpolation count"), QgsProcessingParameterNumber.Integer,
+            defaultValue=BezierGeometry.INTERPOLATION, minValue=BezierGeometry.MIN_INTERPOLATION,
+            maxValue=BezierGeometry.MAX_INTERPOLATION))
+        self.addParameter(QgsProcessingParameterNumber(
+            self.TOLERANCE, self.tr("Interpolation tolerance in meters (0 uses fixed count)"),
+            QgsProcessingParameterNumber.Double, defaultValue=BezierGeometry.INTERPOLATION_TOLERANCE, minValue=0.0))
+        self.addParameter(QgsProcessingParameterBoolean(
+            self.SAVE_CONTROL, self.tr("Save anchors and handles"), defaultValue=False))
+
+    def prepareAlgorithm(self, parameters, context, feedback):
+        self.source_cls = geometryClass(self.parameterAsInt(parameters, self.SOURCE_INTERPOLATION, context), 0.0,
+                                        context.transformContext())
+        self.target_cls = geometryClass(self.parameterAsInt(parameters, self.INTERPOLATION, context),
+                                        self.parameterAsDouble(parameters, self.TOLERANCE, context),
+                                        context.transformContext())
+        self.save_control = self.parameterAsBool(parameters, self.SAVE_CONTROL, context)
+        self.skipped = 0
+        return True
+
+    def outputFields(self, inputFields):
+        # it can be called before prepareAlgorithm
+        self.fields = bezierFields(inputFields, getattr(self, "save_control", False))
+        return self.fields
+
+    def outputWkbType(self, inputWkbType):
+        return QgsWkbTypes.flatType(inputWkbType)
+
+    def processFeature(self, feature, context, feedback):
+        geom = feature.geometry()
+        if geom.isNull() or geom.isEmpty():
+            self.setBezierAttributes(feature, self.fields, None, [], None)
+            return [feature]
+        crs = self.sourceCrs()
+        layer_type = geom.type()
+        parts = ringsOf(geom)
+        single = len(parts) == 1 and len(parts[0]) == 1
+        bgs = []
+        out_parts = []
+        for rings in parts:
+            out_rings = []
+            for ring in rings:
+                bg = self.bezierOf(self.source_cls, crs, feature, ring, single)
+                if bg is not None:
+                    anchors, handles, _ = bg.controlPoints()
+                    bg = self.target_cls.fromControlPoints(crs, anchors, handles, bg.workingCRS)
+                    ring = bg.getPointList(revert=True)
+                else:
+                    self.skipped += 1
+                bgs.append(bg)
+                out_rings.append(ring)
+            out_parts.append(out_rings)
+        out = QgsFeature(feature)
+        geom = geometryOf(out_parts, layer_type, geom.isMultipart())
+        out.setGeometry(geom)
+        self.setBezierAttributes(out, self.fields, geom, bgs, layer_type)
+        return [out]
+
+    def postProcessAlgorithm(self, context, feedback):
+        if self.skipped:
+            feedback.pushInfo(self.tr("{} lines which aren't Bezier curves were copied.").format(self.skipped))
+        return {}
+
+
+class CheckBezierAlgorithm(BezierAlgorithmMixin, QgsProcessingFeatureBasedAlgorithm):
+    """
+    add field telling whether the geometry is bezier line
+    """
+    INTERPOLATION = "INTERPOLATION"
+    CHECK_FIELD = "is_bezier"
+
+    def name(self):
+        return "checkbezier"
+
+    def displayName(self):
+        return self.tr("Check Bezier")
+
+    def outputName(self):
+        return self.tr("Checked")
+
+    def shortHelpString(self):
+        return self.tr("Adds the field \"{}\" which is true if all lines and rings of the feature "
+                       "are Bezier curves that Bezier Editing tool can edit.").format(self.CHECK_FIELD)
+
+    def inputLayerTypes(self):
+        return [QgsProcessing.TypeVectorLine, QgsProcessing.TypeVectorPolygon]
+
+    def supportInPlaceEdit(self, layer):
+        return False
+
+    def initParameters(self, config=None):
+        self.addParameter(QgsProcessingParameterNumber(
+            self.INTERPOLATION, self.tr("Interpolation count of input"), QgsProcessingParameterNumber.Integer,
+            defaultValue=BezierGeometry.INTERPOLATION, minValue=BezierGeometry.MIN_INTERPOLATION,
+            maxValue=BezierGeometry.MAX_INTERPOLATION))
+
+    def prepareAlgorithm(self, parameters, context, feedback):
+        self.cls = geometryClass(self.parameterAsInt(parameters, self.INTERPOLATION, context), 0.0,
+                                 context.transformContext())
+        return True
+
+    def outputFields(self, inputFields):
+        fields = QgsFields(inputFields)
+        fields.append(QgsField(self.CHECK_FIELD, QVariant.Bool))
+        return fields
+
+    def processFeature(self, feature, context, feedback):
+        geom = feature.geometry()
+        is_bezier = False
+        if not geom.isNull() and not geom.isEmpty():
+            parts = ringsOf(geom)
+            single = len(parts) == 1 and len(parts[0]) == 1
+            crs = self.sourceCrs()
+            is_bezier = all(self.isBezier(crs, feature, ring, single) for rings in parts for ring in rings)
+        feature.setAttributes(feature.attributes() + [is_bezier])
+        return [feature]
+
+    def isBezier(self, crs, feature, ring, single):
+        if single and self.cls.convertFeatureControlToBezier(crs, feature) is not None:
+            return True
+        counts = self.cls.featureSegmentCounts(feature) if single else None
+        return self.cls.checkIsBezier(crs, ring, counts)
@@ -16,21 +16,117 @@
  ***************************************************************************/
 """
 from qgis.core import *
-from .fitCurves import *
-import copy
+from qgis.PyQt.QtCore import QByteArray
+from .fitCurves import smoothPoints
+from .fitBatch import fitLine, fitLines, controlPointsOf
+from .fitStream import StreamFitter
+from . import bezier
+from .BezierStorage import STORAGES, toXY, toPointList
+from .BezierHistory import BezierHistory, HistoryRecord
+from .BezierIndex import BoxGrid, PointGrid
+import base64
+import binascii
+import hashlib
+import itertools
 import math
+import struct
 import numpy as np
 
 
+class FreehandEdit:
+    """
+    points of freehand drawing to be fitted. they are smoothed and fitted only with coordinate arrays,
+    so fit() can be called in another thread. the result is added by BezierGeometry.finish_freehand.
+    """
+    __slots__ = ("points", "options", "offset", "last", "front", "reverse", "snap_to_start")
+
+    def __init__(self, points, options):
+        self.points = points  # (N, 2) coordinates of working CRS
+        self.options = options  # maxError, maxIterations, cornerAngle and simplify of fitLine
+        self.offset = 0  # anchor idx of the fitted curves
+        self.last = True  # add the last point of the fitted curves as anchor
+        self.front = 0  # count of anchors deleted from the first after adding the fitted curves
+        self.reverse = False  # flip bezier line after adding the fitted curves
+        self.snap_to_start = False
+
+    def fit(self, isCanceled=None):
+        """
+        return fitted curves as (k, 4, 2) array, or None if isCanceled() stops fitting
+        """
+        return fitLine(smoothPoints(self.points), *self.options, isCanceled=isCanceled)
+
+
+class FreehandTask(QgsTask):
+    """
+    fit FreehandEdit in background. finished(task, result) is called in main thread after fitting.
+    fitting is stopped soon after the task is canceled.
+    """
+
+    def __init__(self, description, edit, finished):
+        super().__init__(description, QgsTask.CanCancel)
+        self.edit = edit
+        self.beziers = None  # fitted curves
+        self.exception = None
+        self._finished = finished
+
+    def run(self):
+        try:
+            self.beziers = self.edit.fit(self.isCanceled)
+        except Exception as e:
+            self.exception = e
+            return False
+        return self.beziers is not None and not self.isCanceled()
+
+    def finished(self, result):
+        self._finished(self, result)
+
+
 class BezierGeometry:
     INTERPOLATION = 10  # interpolation count from anchor to anchor
-
-    def __init__(self, projectCRS):
+    INTERPOLATION_TOLERANCE = 0.0  # max distance in meter between curve and interpolated line. 0 uses fixed INTERPOLATION.
+    MIN_INTERPOLATION = 3  # range of interpolation count of adaptive interpolation
+    MAX_INTERPOLATION = 99
+    SEGMENTS_FIELD = "bezier_seg"  # field name saving interpolation count of each segment
+    CONTROL_FIELD = "bezier_ctl"  # field name saving anchors and handles
+    CONTROL_MAGIC = b"BZC1"  # header of saved anchors and handles
+    CHANGE_LOG_SIZE = 1000  # max count of change log for changesSince
+    CHECK_LOG = False  # log the segment which isn't bezier in checkIsBezier
+    STORAGE = "array"  # point storage backend [array, list]
+    WORKING_CRS = "auto"  # working CRS policy [auto, 3857]. auto uses project CRS if it is projected.
+    FIT_ITERATION = 4  # max count of reparameterization in freehand fitting. more is fewer anchors and slower.
+    FIT_CORNER_ANGLE = 60.0  # freehand line is split at corners sharper than this angle in degree. 0 disables.
+    FIT_SIMPLIFY = 0.25  # simplification tolerance of freehand points before fitting, ratio to fitting tolerance. 0 disables.
+    FIT_STREAM = True  # new freehand line is fitted while drawing instead of at the end of drawing
+    TRANSFORM_CONTEXT = None  # QgsCoordinateTransformContext of transforms. None uses the project in main thread.
+
+    def __init__(self, projectCRS, workingCRS=None):
         self.projectCRS = projectCRS
-        self.points = []  # bezier line points list
-        self.anchor = []  # anchor list
-        self.handle = []  # handle list
-        self.history = []  # undo history
+        if workingCRS is None:
+            workingCRS = self._defaultWorkingCRS(projectCRS)
+        self.workingCRS = workingCRS
+        # meter to working CRS unit
+        self._unitFactor = QgsUnitTypes.fromUnitToUnitFactor(
+            QgsUnitTypes.DistanceMeters, workingCRS.mapUnits())
+        self._identity = projectCRS == workingCRS
+        self._points = self._newStorage()  # bezier line points list
+        self._counts = []  # interpolation count of each segment
+        self._offsets = None  # cache of points idx of anchors
+        self.layoutVersion = 0  # incremented when interpolation count of segments is changed
+        self._dirty = set()  # segment idx whose points need to be recalculated
+        self.anchor = self._newStorage()  # anchor list
+        self.handle = self._newStorage()  # handle list
+        self._anchorGrid = PointGrid()  # index of anchors for snapping
+        self._handleGrid = PointGrid()  # index of handles for snapping
+        self._lineGrid = BoxGrid()  # index of bezier segments for snapping, updated by changesSince
+        self._lineGridVersion = 0  # version of the bezier line indexed by _lineGrid
+        self._lineGridCount = 0  # anchor count of the bezier line indexed by _lineGrid
+        self.history = BezierHistory()  # undo history
+        self.version = 0  # incremented by each change
+        self._changes = []  # change log of (version, kind, idx)
+        self._fullVersion = 0  # changes before this version are unknown
+        self._transforms = {}  # QgsCoordinateTransform cache
+        self._stream = None  # StreamFitter of freehand line while drawing
+        self._streamOffset = 0  # anchor idx of the first anchor added by the stream
 
     @classmethod
     def convertPointToBezier(cls, projectCRS, point):
@@ -40,48 +136,245 @@ class BezierGeometry:
         return bg
 
     @classmethod
-    def checkIsBezier(cls, projectCRS, polyline):
-        is_bezier = True
-        bg = cls(projectCRS)
-        # if polyline length isn't match cause of edited other tool, points are interpolated.
-        if len(polyline) % bg.INTERPOLATION != 1:
-            is_bezier = False
-        else:
-            polyline = [bg._trans(p) for p in polyline]
-            point_list = bg._lineToPointList(polyline)
-            # Check if the number of points accidentally matches with the case of Bezier
-            # if not bezier, calculation of anchor position is different from "A" and "B"
-            for points in point_list:
-                psA, csA, peA, ceA = bg._convertPointListToAnchorAndHandle(
-                    points, "A")
-                psB, csB, peB, ceB = bg._convertPointListToAnchorAndHandle(
-                    points, "B")
-
-                if not(abs(csA[0] - csB[0]) < 0.0001 and abs(csA[1] - csB[1]) < 0.0001 and abs(ceA[0] - ceB[0]) < 0.0001 and abs(ceA[1] - ceB[1]) < 0.0001):
-                    bg.log("{}　{}　{}　{}".format(abs(
-                        csA[0] - csB[0]), abs(csA[1] - csB[1]), abs(ceA[0] - ceB[0]), abs(ceA[1] - ceB[1])))
-                    is_bezier = False
-
-        return is_bezier
+    def checkIsBezier(cls, projectCRS, polyline, counts=None):
+        return cls._bezierWorkingCRS(projectCRS, polyline, counts) is not None
 
     @classmethod
-    def convertLineToBezier(cls, projectCRS, polyline, linetype="bezier"):  # bezier,line,curve
-        bg = cls(projectCRS)
-        polyline = [bg._trans(p) for p in polyline]
+    def convertLineToBezier(cls, projectCRS, polyline, linetype="bezier", counts=None):  # bezier,line,curve
         if linetype == "bezier":
-            point_list = bg._lineToPointList(polyline)
-            bg._invertBezierPointListToBezier(point_list)
+            bg = cls(projectCRS, cls._bezierWorkingCRS(projectCRS, polyline, counts))
+        else:
+            bg = cls(projectCRS)
+        polyline = bg._transArray(polyline)
+        if linetype == "bezier":
+            bg._invertBezierLineToBezier(polyline, cls.lineSegmentCounts(polyline, counts))
         elif linetype == "line":
-            point_list = bg._lineToInterpolatePointList(polyline)
-            bg._invertBezierPointListToBezier(point_list)
+            # straight segments. both handles are on the anchor.
+            bg._setBezier(polyline, np.repeat(polyline, 2, axis=0))
         elif linetype == "curve":
-            geom = QgsGeometry.fromPolylineXY(polyline)
+            geom = QgsGeometry.fromPolylineXY(toPointList(polyline))
             bg._convertGeometryToBezier(geom, 0, scale=1.0, last=True)
 
         return bg
 
+    @classmethod
+    def convertLinesToBezier(cls, projectCRS, polylines, scale=1.0, workers=None, progress=None, isCanceled=None):
+        """
+        make bezier lines from many polylines by fitCurve in a process pool.
+        it is the same as convertLineToBezier with linetype="curve" for each polyline.
+        return list of BezierGeometry in order of polylines, or None if canceled.
+        """
+        bgs = [cls(projectCRS) for _ in polylines]
+        lines = [bg._transArray(polyline) for bg, polyline in zip(bgs, polylines)]
+        maxError = bgs[0]._fitTolerance(scale) if bgs else 0.0
+        results = fitLines(lines, maxError, cls.FIT_ITERATION, cls.FIT_CORNER_ANGLE, cls.FIT_SIMPLIFY,
+                           workers, progress, isCanceled)
+        if results is None:
+            return None
+        for bg, beziers in zip(bgs, results):
+            if len(beziers) > 0:
+                bg._setBezier(*controlPointsOf(beziers))
+        return bgs
+
+    @classmethod
+    def fromControlPoints(cls, projectCRS, anchors, handles, workingCRS=None, counts=None):
+        """
+        make bezier line from anchors (N, 2) and handles (2N, 2) of working CRS.
+        counts is interpolation count of each segment. if it is None, it is calculated by the current setting.
+        """
+        bg = cls(projectCRS, workingCRS)
+        bg._setBezier(anchors, handles, counts)
+        return bg
+
+    @classmethod
+    def convertControlToBezier(cls, projectCRS, blob, geom_hash):
+        """
+        make bezier line from anchors and handles saved by packControlPoints without inversion.
+        return None if blob is invalid or it isn't made from the geometry of geom_hash.
+        """
+        header = struct.Struct("<4s8sHI")
+        if blob is None or len(blob) < header.size:
+            return None
+        magic, saved_hash, crs_len, num = header.unpack_from(blob)
+        if magic != cls.CONTROL_MAGIC or saved_hash != geom_hash or num < 2:
+            return None
+        offset = header.size + crs_len
+        size = offset + (num - 1) * 2 + num * 16 + num * 32
+        if len(blob) != size:
+            return None
+        workingCRS = QgsCoordinateReferenceSystem(blob[header.size:offset].decode("ascii"))
+        if not workingCRS.isValid():
+            return None
+        counts = np.frombuffer(blob, dtype="<u2", count=num - 1, offset=offset)
+        offset += (num - 1) * 2
+        anchors = np.frombuffer(blob, dtype="<f8", count=num * 2, offset=offset).reshape(-1, 2)
+        offset += num * 16
+        handles = np.frombuffer(blob, dtype="<f8", count=num * 4, offset=offset).reshape(-1, 2)
+        return cls.fromControlPoints(projectCRS, anchors, handles, workingCRS, counts.tolist())
+
+    @classmethod
+    def convertFeatureControlToBezier(cls, projectCRS, feature):
+        """
+        make bezier line from anchors and handles saved in the feature,
+        or return None if they aren't saved or the geometry is changed after saved.
+        """
+        idx = feature.fields().indexOf(cls.CONTROL_FIELD)
+        if idx == -1:
+            return None
+        value = feature.attribute(idx)
+        if isinstance(value, QByteArray):
+            blob = bytes(value)
+        elif isinstance(value, str):
+            try:
+                blob = base64.b64decode(value, validate=True)
+            except (binascii.Error, ValueError):
+                return None
+        else:
+            return None
+        # anchors and handles are saved in layer CRS geometry, so the hash is checked before transformed
+        return cls.convertControlToBezier(projectCRS, blob, cls.geometryHash(feature.geometry()))
+
+    @classmethod
+    def featureSegmentCounts(cls, feature):
+        """
+        return interpolation count of each segment saved in the feature, or None if it isn't saved.
+        """
+        idx = feature.fields().indexOf(cls.SEGMENTS_FIELD)
+        if idx == -1:
+            return None
+        return cls.decodeSegmentCounts(feature.attribute(idx), cls.geometryHash(feature.geometry()))
+
+    @staticmethod
+    def fitsField(field, text):
+        """
+        return True if text is saved in the field without truncation. length 0 is unlimited.
+        """
+        return field.length() <= 0 or len(text) <= field.length()
+
+    @staticmethod
+    def geometryHash(geom):
+        """
+        return hash of the vertices of line or polygon exterior ring.
+        it is saved with anchors and handles to check they are made from the geometry.
+        """
+        g = QgsGeometry(geom)
+        g.convertToSingleType()
+        if g.type() == QgsWkbTypes.PolygonGeometry:
+            polygon = g.asPolygon()
+            polyline = polygon[0] if polygon else []
+        else:
+            polyline = g.asPolyline()
+        xys = np.array([(p.x(), p.y()) for p in polyline], dtype="<f8")
+        return hashlib.sha1(xys.tobytes()).digest()[:8]
+
+    @classmethod
+    def _defaultWorkingCRS(cls, projectCRS):
+        """
+        return working CRS. projected CRS is used as it is, geographic CRS is converted to EPSG:3857.
+        """
+        if cls.WORKING_CRS == "auto" and projectCRS.isValid() and not projectCRS.isGeographic():
+            return projectCRS
+        return QgsCoordinateReferenceSystem("EPSG:3857")
+
+    @classmethod
+    def lineSegmentCounts(cls, polyline, counts=None):
+        """
+        return interpolation count of each segment of polyline, or None if the number of points doesn't match.
+        counts is the saved interpolation counts. if it is None, fixed INTERPOLATION is assumed.
+        """
+        # if polyline length isn't match cause of edited other tool, points are interpolated.
+        if counts is None:
+            if len(polyline) % cls.INTERPOLATION != 1:
+                return None
+            return [cls.INTERPOLATION] * (len(polyline) // cls.INTERPOLATION)
+        counts = np.asarray(counts)
+        if counts.sum() + 1 != len(polyline) or np.any(counts < cls.MIN_INTERPOLATION) or \
+                np.any(counts > cls.MAX_INTERPOLATION):
+            return None
+        return counts.tolist()
+
+    @staticmethod
+    def segmentCountsCheck(text, geom_hash):
+        # checksum of the counts text and the geometry saved with them
+        return hashlib.sha1(geom_hash + text.encode("ascii")).hexdigest()[:8]
+
+    @classmethod
+    def encodeSegmentCounts(cls, counts, geom_hash=None):
+        """
+        encode interpolation counts to text. the same counts in a row are written as count*repeat, e.g. "10*3,4".
+        with geom_hash of the geometry, checksum is written first, e.g. "1a2b3c4d:10*3,4",
+        so truncated or changed text and the geometry changed after saved are detected.
+        """
+        items = []
+        for n, group in itertools.groupby(int(n) for n in counts):
+            repeat = len(list(group))
+            items.append("{}*{}".format(n, repeat) if repeat > 1 else str(n))
+        text = ",".join(items)
+        if geom_hash is None:
+            return text
+        return "{}:{}".format(cls.segmentCountsCheck(text, geom_hash), text)
+
+    @classmethod
+    def decodeSegmentCounts(cls, text, geom_hash=None):
+        """
+        decode interpolation counts from text made by encodeSegmentCounts. return None if it is invalid.
+        text with checksum is valid only for the geometry of geom_hash. text without it is saved by older version.
+        """
+        if not isinstance(text, str) or text == "":
+            return None
+        check, _, body = text.rpartition(":")
+        if check:
+            if geom_hash is None or check != cls.segmentCountsCheck(body, geom_hash):
+                return None
+            text = body
+        counts = []
+        try:
+            for item in text.split(","):
+                n, _, repeat = item.partition("*")
+                counts.extend([int(n)] * (int(repeat) if repeat else 1))
+        except ValueError:
+            return None
+        return counts
+
+    @classmethod
+    def _bezierWorkingCRS(cls, projectCRS, polyline, counts=None):
+        """
+        return working CRS in which polyline is bezier line, or None if it isn't bezier line.
+        features created in EPSG:3857 by older version are also accepted in projected CRS.
+        """
+        counts = cls.lineSegmentCounts(polyline, counts)
+        if counts is None:
+            return None
+        workingCRS = cls._defaultWorkingCRS(projectCRS)
+        candidates = [workingCRS]
+        if workingCRS.authid() != "EPSG:3857":
+            candidates.append(QgsCoordinateReferenceSystem("EPSG:3857"))
+        for crs in candidates:
+            if cls(projectCRS, crs)._isBezierLine(polyline, counts):
+                return crs
+        return None
+
+    def _isBezierLine(self, polyline, counts):
+        polyline = self._transArray(polyline)
+        tolerance = 0.0001 * self._unitFactor
+        # Check if the number of points accidentally matches with the case of Bezier
+        # if not bezier, calculation of anchor position is different from "A" and "B"
+        # all segments of the same interpolation count are solved at once, and it returns at the first group failed.
+        for segs, segments in self._segmentGroups(polyline, counts):
+            psA, csA, peA, ceA = self._convertSegmentsToAnchorAndHandle(segments, "A")
+            psB, csB, peB, ceB = self._convertSegmentsToAnchorAndHandle(segments, "B")
+            diff = np.hstack([np.abs(csA - csB), np.abs(ceA - ceB)])
+            failed = np.flatnonzero(~(diff < tolerance).all(axis=1))
+            if len(failed):
+                if self.CHECK_LOG:
+                    self.log("segment {}: {}　{}　{}　{}".format(segs[failed[0]], *diff[failed[0]]))
+                return False
+        return True
+
     def setCRS(self, projectCRS):
         self.projectCRS = projectCRS
+        self._identity = projectCRS == self.workingCRS
+        self._transforms = {}
 
     def asGeometry(self, layer_type, layer_wkbtype):
         """
@@ -90,26 +383,28 @@ class BezierGeometry:
         result = None
         geom = None
         num_anchor = self.anchorCount()
+        points = self.points.array()
+        is_closed = self._isClosed()
 
         if layer_type == QgsWkbTypes.PointGeometry and num_anchor == 1:
-            geom = QgsGeometry.fromPointXY(self.points[0])
+            geom = QgsGeometry.fromPointXY(self.points.point(0))
             result = True
         elif layer_type == QgsWkbTypes.LineGeometry and num_anchor >= 2:
             if QgsWkbTypes.isMultiType(layer_wkbtype):
-                geom = QgsGeometry.fromMultiPolylineXY([self.points])
+                geom = QgsGeometry.fromMultiPolylineXY([self.points.points()])
                 result = True
             else:
-                geom = QgsGeometry.fromPolylineXY(self.points)
+                geom = QgsGeometry.fromPolylineXY(self.points.points())
                 result = True
-        elif layer_type == QgsWkbTypes.PolygonGeometry and num_anchor >= 3 and self.points[0] == self.points[-1]:
-            geom = QgsGeometry.fromPolygonXY([self.points])
+        elif layer_type == QgsWkbTypes.PolygonGeometry and num_anchor >= 3 and is_closed:
+            geom = QgsGeometry.fromPolygonXY([self.points.points()])
             result = True
-        elif layer_type == QgsWkbTypes.PolygonGeometry and num_anchor >= 3 and self.points[0] != self.points[-1]:
+        elif layer_type == QgsWkbTypes.PolygonGeometry and num_anchor >= 3 and not is_closed:
             # if first point and last point is different, interpolate points.
             point_list = self._lineToInterpolatePointList(
-                [self.points[-1], self.points[0]])
+                [points[-1], points[0]])
             geom = QgsGeometry.fromPolygonXY(
-                [self.points + point_list[0][1:-1]])
+                [toPointList(np.vstack([points, point_list[0][1:-1]]))])
             result = True
         elif layer_type == QgsWkbTypes.LineGeometry and num_anchor < 2:
             result = None
@@ -124,70 +419,56 @@ class BezierGeometry:
         """
         return bezier line points list
         """
-        points = [self._trans(p, revert=True) for p in self.points]
+        points = toPointList(self._transArray(self.points.array(), revert=True))
         return points
 
     def add_anchor(self, idx, point, undo=True):
         point = self._trans(point)
         if undo:
-            self.history.append({"state": "add_anchor", "pointidx": idx})
+            self.history.append(HistoryRecord("add_anchor", idx))
         self._addAnchor(idx, point)
 
     def move_anchor(self, idx, point, undo=True):
         point = self._trans(point)
         if undo:
-            self.history.append(
-                {"state": "move_anchor", "pointidx": idx, "point": point})
+            self.history.append(HistoryRecord("move_anchor", idx, point))
         self._moveAnchor(idx, point)
 
     def move_anchor2(self, idx, point):
         point = self._trans(point)
-        self.history.append(
-            {"state": "move_anchor2", "pointidx": idx, "point": point})
+        self.history.append(HistoryRecord("move_anchor2", idx, point))
         self._moveAnchor(idx, point)
         self._moveAnchor(0, point)
 
     def delete_anchor(self, idx, point, undo=True):
         if undo:
-            self.history.append(
-                {"state": "delete_anchor",
-                 "pointidx": idx,
-                 "point": point,
-                 "ctrlpoint0": self.getHandle(idx * 2),
-                 "ctrlpoint1": self.getHandle(idx * 2 + 1)
-                 }
-            )
+            # the anchor position of working CRS is saved instead of point
+            self.history.append(HistoryRecord(
+                "delete_anchor", idx, self.anchor.xy(idx),
+                self.handle.xy(idx * 2), self.handle.xy(idx * 2 + 1)))
         self._deleteAnchor(idx)
 
     def delete_anchor2(self, idx, point):
         point = self._trans(point)
-        self.history.append(
-            {"state": "delete_anchor2",
-             "pointidx": idx,
-             "point": point,
-             "ctrlpoint0": self.getHandle(1),
-             "ctrlpoint1": self.getHandle(idx * 2)
-             }
-        )
+        self.history.append(HistoryRecord(
+            "delete_anchor2", idx, point, self.handle.xy(1), self.handle.xy(idx * 2)))
         self._deleteAnchor(idx)
         self._deleteAnchor(0)
-        self._addAnchor(self.anchorCount(), self.getAnchor(0))
+        self._addAnchor(self.anchorCount(), self.anchor.xy(0))
 
     def move_handle(self, idx, point, undo=True):
         point = self._trans(point)
         if undo:
-            self.history.append(
-                {"state": "move_handle", "pointidx": idx, "point": point})
+            self.history.append(HistoryRecord("move_handle", idx, point))
         self._moveHandle(idx, point)
 
     def other_handle(self, handle_idx, point):
-        point = self._trans(point)
+        point = toXY(self._trans(point))
         other_handle_idx = handle_idx + \
             1 if handle_idx % 2 == 0 else handle_idx - 1
         anchor_idx = math.floor(handle_idx/2)
-        anchor_point = self.getAnchor(anchor_idx)
-        other_point = QgsPointXY(
-            anchor_point[0] - (point[0] - anchor_point[0]), anchor_point[1] - (point[1] - anchor_point[1]))
+        anchor_point = self.anchor.xy(anchor_idx)
+        other_point = QgsPointXY(*(anchor_point - (point - anchor_point)))
         other_point = self._trans(other_point, revert=True)
         return other_handle_idx, other_point
 
@@ -197,10 +478,10 @@ class BezierGeometry:
         fix the first handle with fix_first option.
         move the second handle to the anchor position with remove_second option.
         """
-        point = self._trans(point)
+        point = toXY(self._trans(point))
         handle_idx = anchor_idx * 2
-        p = self.getAnchor(anchor_idx)
-        pb = QgsPointXY(p[0] - (point[0] - p[0]), p[1] - (point[1] - p[1]))
+        p = self.anchor.xy(anchor_idx)
+        pb = p - (point - p)
         if remove_second:
             self._moveHandle(handle_idx, pb)
             self._moveHandle(handle_idx + 1, p)
@@ -209,50 +490,52 @@ class BezierGeometry:
         else:
             self._moveHandle(handle_idx, pb)
             self._moveHandle(handle_idx + 1, point)
-        pb = self._trans(pb, revert=True)
-        p = self._trans(p, revert=True)
+        pb = self._trans(QgsPointXY(*pb), revert=True)
+        p = self._trans(QgsPointXY(*p), revert=True)
         return handle_idx, pb, p
 
     def delete_handle(self, idx, point):
         point = self._trans(point)
-        self.history.append(
-            {"state": "delete_handle",
-             "pointidx": idx,
-             "point": point,
-             }
-        )
-        pnt = self.getAnchor(int(idx / 2))
+        self.history.append(HistoryRecord("delete_handle", idx, point))
+        pnt = self.anchor.xy(int(idx / 2))
         self._moveHandle(idx, pnt)
 
     def flip_line(self):
-        self.history.append({"state": "flip_line"})
+        self.history.append(HistoryRecord("flip_line"))
         self._flipBezierLine()
 
     def insert_anchor(self, point_idx, point):
         point = self._trans(point)
         anchor_idx = self._AnchorIdx(point_idx)
-        self.history.append(
-            {"state": "insert_anchor",
-             "pointidx": anchor_idx,
-             "ctrlpoint0": self.getHandle((anchor_idx - 1) * 2 + 1),
-             "ctrlpoint1": self.getHandle((anchor_idx - 1) * 2 + 2)
-             }
-        )
+        self.history.append(HistoryRecord(
+            "insert_anchor", anchor_idx,
+            ctrlpoint0=self.handle.xy((anchor_idx - 1) * 2 + 1),
+            ctrlpoint1=self.handle.xy((anchor_idx - 1) * 2 + 2)))
         self._insertAnchorPointToBezier(point_idx, anchor_idx, point)
 
     def modified_by_geometry(self, update_geom, layer_type, scale, snap_to_start):
         """
         update bezier line by geometry. if no bezier line, added new.
         """
+        edit = self.start_freehand(update_geom, layer_type, scale, snap_to_start)
+        if edit is not None:
+            self.finish_freehand(edit, edit.fit())
+
+    def start_freehand(self, update_geom, layer_type, scale, snap_to_start):
+        """
+        update bezier line by geometry except for fitting, and return FreehandEdit of the points to be fitted.
+        return None if there is nothing to fit.
+        bezier line must not be changed until finish_freehand is called with the fitted curves.
+        """
 
         update_geom = self._transgeom(update_geom)
-        dist = scale / 250
-        bezier_line = self.points
+        dist = self._metersToWorking(scale / 250)
+        bezier_line = self.points.points()
         update_line = update_geom.asPolyline()
         bezier_geom = QgsGeometry.fromPolylineXY(bezier_line)
 
         if len(update_line) < 3:
-            return
+            return None
 
         # no bezier line or only a point.
         # The number of anchors is 1 instead of 0 because anchors are added on click if no bezier line.
@@ -262,29 +545,18 @@ class BezierGeometry:
             if len(update_line) == 2:
                 self._deleteAnchor(0)
                 self.add_anchor(0, update_line[0])
+                if snap_to_start:
+                    self._moveAnchor(self.anchorCount() - 1, self.anchor.xy(0))
+                return None
             # if there is no point and update line is line
-            elif len(self.history) == 0 and len(update_line) > 2:
+            elif len(self.history) == 0 and not self.history.evicted:
                 self._deleteAnchor(0)
-                self.history.append({"state": "start_freehand"})
-                geom = self._smoothingGeometry(update_line)
-                pointnum, _, _ = self._convertGeometryToBezier(
-                    geom, 0, scale, last=True)
-                self.history.append(
-                    {"state": "insert_geom", "pointidx": 0, "pointnum": pointnum, "cp_first": None,
-                     "cp_last": None})
-                self.history.append(
-                    {"state": "end_freehand", "direction": "forward"})
+                self.history.append(HistoryRecord("start_freehand"))
+                return self._freehandEdit(update_line, 0, scale, snap_to_start)
             # if there is only a point and update line is line
-            elif len(self.history) > 0 and len(update_line) > 2:
-                self.history.append({"state": "start_freehand"})
-                geom = self._smoothingGeometry(update_line)
-                pointnum, _, _ = self._convertGeometryToBezier(
-                    geom, 1, scale, last=True)
-                self.history.append(
-                    {"state": "insert_geom", "pointidx": 1, "pointnum": pointnum, "cp_first": None,
-                     "cp_last": None})
-                self.history.append(
-                    {"state": "end_freehand", "direction": "forward"})
+            else:
+                self.history.append(HistoryRecord("start_freehand"))
+                return self._freehandEdit(update_line, 1, scale, snap_to_start)
         # there is bezier line and update line is line
         else:
             startpnt = update_line[0]
@@ -301,10 +573,11 @@ class BezierGeometry:
             v2 = np.array(update_line[1]) - np.array(update_line[0])
             direction = np.dot(v1, v2)
 
-            self.history.append({"state": "start_freehand"})
+            self.history.append(HistoryRecord("start_freehand"))
             # if backward, flip bezier line
             if direction < 0:
                 self._flipBezierLine()
+                bezier_line = self.points.points()
                 reversed_geom = QgsGeometry.fromPolylineXY(bezier_line)
                 startpnt_is_near, start_anchoridx, start_vertexidx = self._closestAnchorOfGeometry(startpnt,
                                                                                                    reversed_geom, dist)
@@ -321,60 +594,29 @@ class BezierGeometry:
                     point_list[last_anchoridx -
                                1][self._pointListIdx(last_vertexidx):]
 
-                geom = self._smoothingGeometry(polyline)
                 for i in range(start_anchoridx, last_anchoridx):
-                    self.history.append(
-                        {"state": "delete_anchor",
-                         "pointidx": start_anchoridx,
-                         "point": self.getAnchor(start_anchoridx),
-                         "ctrlpoint0": self.getHandle(start_anchoridx * 2),
-                         "ctrlpoint1": self.getHandle(start_anchoridx * 2 + 1)
-                         }
-                    )
+                    self.history.append(HistoryRecord(
+                        "delete_anchor", start_anchoridx, self.anchor.xy(start_anchoridx),
+                        self.handle.xy(start_anchoridx * 2), self.handle.xy(start_anchoridx * 2 + 1)))
                     self._deleteAnchor(start_anchoridx)
 
-                pointnum, cp_first, cp_last = self._convertGeometryToBezier(
-                    geom, start_anchoridx, scale, last=False)
-                self.history.append(
-                    {"state": "insert_geom", "pointidx": start_anchoridx, "pointnum": pointnum, "cp_first": cp_first,
-                     "cp_last": cp_last})
+                edit = self._freehandEdit(polyline, start_anchoridx, scale, snap_to_start, last=False)
             # modify polygon
             elif layer_type == QgsWkbTypes.PolygonGeometry and lastpnt_is_near and last_vertexidx <= start_vertexidx:
                 polyline = point_list[start_anchoridx - 1][0:self._pointListIdx(start_vertexidx)] + update_line + \
                     point_list[last_anchoridx -
                                1][self._pointListIdx(last_vertexidx):]
-                geom = self._smoothingGeometry(polyline)
                 for i in range(start_anchoridx, self.anchorCount()):
-                    self.history.append(
-                        {"state": "delete_anchor",
-                         "pointidx": start_anchoridx,
-                         "point": self.getAnchor(start_anchoridx),
-                         "ctrlpoint0": self.getHandle(start_anchoridx * 2),
-                         "ctrlpoint1": self.getHandle(start_anchoridx * 2 + 1)
-                         }
-                    )
+                    self.history.append(HistoryRecord(
+                        "delete_anchor", start_anchoridx, self.anchor.xy(start_anchoridx),
+                        self.handle.xy(start_anchoridx * 2), self.handle.xy(start_anchoridx * 2 + 1)))
                     self._deleteAnchor(start_anchoridx)
 
-                pointnum, cp_first, cp_last = self._convertGeometryToBezier(
-                    geom, start_anchoridx, scale, last=True)
-                self.history.append(
-                    {"state": "insert_geom", "pointidx": start_anchoridx, "pointnum": pointnum, "cp_first": cp_first,
-                     "cp_last": cp_last})
-                for i in range(0, last_anchoridx):
-                    self.history.append(
-                        {"state": "delete_anchor",
-                         "pointidx": 0,
-                         "point": self.getAnchor(0),
-                         "ctrlpoint0": self.getHandle(0),
-                         "ctrlpoint1": self.getHandle(1)
-                         }
-                    )
-                    self._deleteAnchor(0)
+                # anchors before the last point are deleted after fitted curves are added
+                edit = self._freehandEdit(polyline, start_anchoridx, scale, snap_to_start, front=last_anchoridx)
 
             # modify end line, return to backward, end line is near of last anchor
-            elif not lastpnt_is_near or (lastpnt_is_near and last_vertexidx <= start_vertexidx) or last_anchoridx > len(
-                    point_list):
-
+            else:
                 if start_anchoridx == self.anchorCount():
                     polyline = update_line
                 else:
@@ -382,154 +624,344 @@ class BezierGeometry:
                                           1][0:self._pointListIdx(start_vertexidx)] + update_line
                 last_anchoridx = self.anchorCount()
 
-                geom = self._smoothingGeometry(polyline)
                 for i in range(start_anchoridx, last_anchoridx):
-                    self.history.append(
-                        {"state": "delete_anchor",
-                         "pointidx": start_anchoridx,
-                         "point": self.getAnchor(start_anchoridx),
-                         "ctrlpoint0": self.getHandle(start_anchoridx * 2),
-                         "ctrlpoint1": self.getHandle(start_anchoridx * 2 + 1)
-                         }
-                    )
+                    self.history.append(HistoryRecord(
+                        "delete_anchor", start_anchoridx, self.anchor.xy(start_anchoridx),
+                        self.handle.xy(start_anchoridx * 2), self.handle.xy(start_anchoridx * 2 + 1)))
                     self._deleteAnchor(start_anchoridx)
 
-                pointnum, cp_first, cp_last = self._convertGeometryToBezier(
-                    geom, start_anchoridx, scale, last=True)
-                self.history.append(
-                    {"state": "insert_geom", "pointidx": start_anchoridx, "pointnum": pointnum, "cp_first": cp_first,
-                     "cp_last": cp_last})
+                edit = self._freehandEdit(polyline, start_anchoridx, scale, snap_to_start)
 
-            self.history.append(
-                {"state": "end_freehand", "direction": "forward"})
-            # return to direction
-            if direction < 0:
-                self._flipBezierLine()
-                self.history[-1]["direction"] = "reverse"
+            # return to direction after fitting
+            edit.reverse = direction < 0
+            return edit
+
+    def finish_freehand(self, edit, beziers):
+        """
+        add curves fitted to FreehandEdit points to bezier line and finish updating by geometry
+        """
+        pointnum, cp_first, cp_last = self._insertBeziers(beziers, edit.offset, edit.last)
+        self.history.append(HistoryRecord(
+            "insert_geom", edit.offset, ctrlpoint0=cp_first, ctrlpoint1=cp_last, pointnum=pointnum))
+        for i in range(edit.front):
+            self.history.append(HistoryRecord(
+                "delete_anchor", 0, self.anchor.xy(0),
+                self.handle.xy(0), self.handle.xy(1)))
+            self._deleteAnchor(0)
+        self.history.append(HistoryRecord("end_freehand", direction="forward"))
+        if edit.reverse:
+            self._flipBezierLine()
+            self.history.last().direction = "reverse"
 
         # If it was snapped to the start point, move the last point shifted to the first point for smooth processing
+        if edit.snap_to_start:
+            self._moveAnchor(self.anchorCount() - 1, self.anchor.xy(0))
+
+    def cancel_freehand(self, edit):
+        """
+        restore bezier line updated by start_freehand without fitted curves. return length of history.
+        """
+        edit.snap_to_start = False
+        self.finish_freehand(edit, np.empty((0, 4, 2)))
+        return self.undo()
+
+    def start_stream(self, scale):
+        """
+        start fitting freehand line while drawing. only new line from the only anchor is fitted while drawing.
+        return True if started.
+        """
+        self._stream = None
+        if not self.FIT_STREAM or self.anchorCount() != 1:
+            return False
+        # the only anchor is replaced by fitted line if there is no history, as modified_by_geometry
+        self._streamOffset = 0 if len(self.history) == 0 and not self.history.evicted else 1
+        self._stream = StreamFitter(self.anchor.xy(0), self._fitTolerance(scale), self.FIT_ITERATION,
+                                    self.FIT_CORNER_ANGLE, self.FIT_SIMPLIFY)
+        return True
+
+    def isStreaming(self):
+        return self._stream is not None
+
+    def add_stream_point(self, point):
+        """
+        add a point of freehand line while drawing. return True if anchors are added.
+        """
+        if self._stream is None:
+            return False
+        return self._addStreamBeziers(self._stream.add(toXY(self._trans(point))))
+
+    def finish_stream(self, snap_to_start):
+        """
+        fit the rest of freehand line and add it to history as one freehand drawing
+        """
+        stream, self._stream = self._stream, None
+        if stream is None:
+            return
+        # no line is drawn
+        if stream.count < 2:
+            return
+        self._addStreamBeziers(stream.finish())
+        offset = self._streamOffset
+        self.history.append(HistoryRecord("start_freehand"))
+        self.history.append(HistoryRecord(
+            "insert_geom", offset, pointnum=self.anchorCount() - offset))
+        self.history.append(HistoryRecord("end_freehand", direction="forward"))
         if snap_to_start:
-            self._moveAnchor(self.anchorCount() - 1, self.getAnchor(0))
+            self._moveAnchor(self.anchorCount() - 1, self.anchor.xy(0))
+
+    def cancel_stream(self):
+        """
+        stop fitting freehand line and delete anchors added while drawing
+        """
+        if self._stream is None:
+            return
+        self._stream = None
+        while self.anchorCount() > 1:
+            self._deleteAnchor(self.anchorCount() - 1)
+        self._moveHandle(1, self.anchor.xy(0))
+
+    def _addStreamBeziers(self, beziers):
+        # the first point of each curve is the last anchor
+        for bezier in beziers:
+            idx = self.anchorCount() - 1
+            self._moveHandle(idx * 2 + 1, bezier[1])
+            self._addAnchor(idx + 1, bezier[3])
+            self._moveHandle((idx + 1) * 2, bezier[2])
+        return len(beziers) > 0
 
     def split_line(self, idx, point, isAnchor):
         """
-        return two bezier line split at point
+        return two bezier line split at point and their interpolation counts
         """
         # if split position is on anchor
         point = self._trans(point)
         if isAnchor:
-            lineA = self.points[0:self._pointsIdx(idx) + 1]
-            lineB = self.points[self._pointsIdx(idx):]
+            anchor_idx = idx
         # if split position is on line, insert anchor at the position first
         else:
             anchor_idx = self._AnchorIdx(idx)
             self._insertAnchorPointToBezier(idx, anchor_idx, point)
-            lineA = self.points[0:self._pointsIdx(anchor_idx) + 1]
-            lineB = self.points[self._pointsIdx(anchor_idx):]
-        lineA = [self._trans(p, revert=True) for p in lineA]
-        lineB = [self._trans(p, revert=True) for p in lineB]
+        points = self.points.array()
+        lineA = points[0:self._pointsIdx(anchor_idx) + 1]
+        lineB = points[self._pointsIdx(anchor_idx):]
+        lineA = toPointList(self._transArray(lineA, revert=True))
+        lineB = toPointList(self._transArray(lineB, revert=True))
 
-        return lineA, lineB
+        return lineA, lineB, self._counts[:anchor_idx], self._counts[anchor_idx:]
 
     def anchorCount(self):
         return len(self.anchor)
 
+    def pointCount(self):
+        return len(self.points)
+
+    def useFixedInterpolation(self):
+        """
+        interpolate all segments by fixed INTERPOLATION count from now on, for the layer which can't save
+        interpolation counts. adaptive counts can't be found from the geometry without them.
+        return True if bezier line points are changed.
+        """
+        if self.INTERPOLATION_TOLERANCE <= 0:
+            return False
+        self.INTERPOLATION_TOLERANCE = 0.0
+        if self.anchorCount() >= 2:
+            anchors, handles, _ = self.controlPoints()
+            self._setBezier(anchors, handles)
+        return True
+
+    def segmentCounts(self, layer_type=None):
+        """
+        return interpolation count of each segment. it is saved with feature to convert it to bezier again.
+        for polygon which isn't closed, the segment closing polygon by asGeometry is added.
+        """
+        return self.controlPoints(layer_type)[2]
+
+    def controlPoints(self, layer_type=None, first=0, last=None):
+        """
+        return anchors, handles and interpolation counts from anchor first to last as they are saved with feature.
+        for polygon which isn't closed, the segment closing polygon by asGeometry is added.
+        """
+        self._flush()
+        if last is None:
+            last = self.anchorCount() - 1
+        anchors = self.anchor.array()[first:last + 1].copy()
+        handles = self.handle.array()[first * 2:last * 2 + 2].copy()
+        counts = self._counts[first:last]
+        if layer_type == QgsWkbTypes.PolygonGeometry and self.anchorCount() >= 3 and not self._isClosed():
+            # straight segment from the last anchor to the first anchor
+            anchors = np.vstack([anchors, anchors[:1]])
+            handles[-1] = anchors[-2]
+            handles = np.vstack([handles, anchors[:1], anchors[:1]])
+            counts = counts + [len(self._lineToInterpolatePointList(anchors[[-2, -1]])[0]) - 1]
+        return anchors, handles, counts
+
+    def packControlPoints(self, control, geom_hash):
+        """
+        pack anchors, handles and interpolation counts from controlPoints to binary with working CRS.
+        geom_hash is the hash of the geometry saved with it. see geometryHash.
+        """
+        anchors, handles, counts = control
+        authid = self.workingCRS.authid().encode("ascii")
+        return b"".join([
+            struct.pack("<4s8sHI", self.CONTROL_MAGIC, geom_hash, len(authid), len(anchors)),
+            authid,
+            np.asarray(counts, dtype="<u2").tobytes(),
+            np.asarray(anchors, dtype="<f8").tobytes(),
+            np.asarray(handles, dtype="<f8").tobytes(),
+        ])
+
     def getAnchorList(self, revert=False):
         if revert:
-            anchorList = [self._trans(p, revert=True) for p in self.anchor]
+            anchorList = toPointList(self._transArray(self.anchor.array(), revert=True))
         else:
-            anchorList = self.anchor
+            anchorList = self.anchor.points()
         return anchorList
 
     def getAnchor(self, idx, revert=False):
-        p = self.anchor[idx]
+        p = self.anchor.point(idx)
         if revert:
             p = self._trans(p, revert=True)
         return p
 
     def getHandleList(self, revert=False):
         if revert:
-            handleList = [self._trans(p, revert=True) for p in self.handle]
+            handleList = toPointList(self._transArray(self.handle.array(), revert=True))
         else:
-            handleList = self.handle
+            handleList = self.handle.points()
         return handleList
 
     def getHandle(self, idx, revert=False):
-        p = self.handle[idx]
+        p = self.handle.point(idx)
         if revert:
             p = self._trans(p, revert=True)
         return p
 
     def getPointList(self, revert=False):
         if revert:
-            pointList = [self._trans(p, revert=True) for p in self.points]
+            pointList = toPointList(self._transArray(self.points.array(), revert=True))
         else:
-            pointList = self.points
+            pointList = self.points.points()
         return pointList
 
     def reset(self):
-        self.points = []
-        self.anchor = []
-        self.handle = []
-        self.history = []
+        self._points = self._newStorage()
+        self._counts = []
+        self._countsChanged()
+        self._dirty = set()
+        self.anchor = self._newStorage()
+        self.handle = self._newStorage()
+        self.history = BezierHistory()
+        self._stream = None
+        self._changed("reset")
+
+    def changesSince(self, version):
+        """
+        return list of (kind, idx) changed after version. kind is add_anchor, delete_anchor, move_anchor or move_handle.
+        return None if the changes are unknown, e.g. all points are replaced or flipped.
+        """
+        if version < self._fullVersion:
+            return None
+        return [(kind, idx) for v, kind, idx in self._changes if v > version]
+
+    def getSegmentPointList(self, anchor_idx, revert=False):
+        """
+        return the first point idx and the points of bezier line from anchor_idx to anchor_idx + 1
+        """
+        points = self.points.array()
+        start = self._pointsIdx(anchor_idx)
+        points = points[start:self._pointsIdx(anchor_idx + 1) + 1]
+        if revert:
+            points = self._transArray(points, revert=True)
+        return start, toPointList(points)
+
+    def checkSnap(self, point, clicked_idx, d, handle=True):
+        """
+        snap to anchor, handle, bezier line and start anchor with one call.
+        the point and d are transformed only once, but each kind is still queried separately:
+        anchors and handles in their own point grid, the line in the segment grid and the start anchor directly.
+        return lists of snapped, snap_point and snap_idx in this order.
+        each item is the same as checkSnapToAnchor, checkSnapToHandle, checkSnapToLine and checkSnapToStart.
+        if handle=False, handle isn't snapped.
+        """
+        point = self._trans(point)
+        d = self._metersToWorking(d)
+        hits = [self._snapToAnchor(point, clicked_idx, d),
+                self._snapToHandle(point, d) if handle else (False, None, None),
+                self._snapToLine(point, d),
+                self._snapToStart(point, d)]
+        snapped, snap_point, snap_idx = (list(items) for items in zip(*hits))
+        return snapped, snap_point, snap_idx
 
     def checkSnapToAnchor(self, point, clicked_idx, d):
         point = self._trans(point)
+        d = self._metersToWorking(d)
+        return self._snapToAnchor(point, clicked_idx, d)
+
+    def _snapToAnchor(self, point, clicked_idx, d):
         snapped = False
         snap_point = None
         snap_idx = None
-        for i, p in reversed(list(enumerate(self.anchor))):
-            near = self._eachPointIsNear(p, point, d)
-            # if anchor is not moving
-            if clicked_idx is None:
-                if near:
-                    snapped = True
-                    snap_idx = i
-                    snap_point = self._trans(p, revert=True)
-                    break
+        anchors = self.anchor.array()
+        # the last anchor is snapped if anchors are overlapped
+        for i in self._anchorGrid.candidates(anchors, point, d):
             # if the anchor is moving, except for snapping to itself
-            elif clicked_idx != i:
-                if near:
-                    snapped = True
-                    snap_idx = i
-                    snap_point = self._trans(p, revert=True)
-                    break
+            if clicked_idx == i:
+                continue
+            p = anchors[i]
+            if self._eachPointIsNear(p, point, d):
+                snapped = True
+                snap_idx = i
+                snap_point = self._trans(QgsPointXY(*p), revert=True)
+                break
         return snapped, snap_point, snap_idx
 
     def checkSnapToHandle(self, point, d):
         point = self._trans(point)
+        d = self._metersToWorking(d)
+        return self._snapToHandle(point, d)
+
+    def _snapToHandle(self, point, d):
         snapped = False
         snap_point = None
         snap_idx = None
-        for i, p in reversed(list(enumerate(self.handle))):
-            if i == 0 or i == len(self.handle)-1:
+        handles = self.handle.array()
+        for i in self._handleGrid.candidates(handles, point, d):
+            # handles of both ends are on the anchors
+            if i == 0 or i == len(handles) - 1:
                 continue
-            near = self._eachPointIsNear(p, point, d)
-            if near:
+            p = handles[i]
+            if self._eachPointIsNear(p, point, d):
                 snapped = True
                 snap_idx = i
-                snap_point = self._trans(p, revert=True)
+                snap_point = self._trans(QgsPointXY(*p), revert=True)
                 break
         return snapped, snap_point, snap_idx
 
     def checkSnapToLine(self, point, d):
         point = self._trans(point)
+        d = self._metersToWorking(d)
+        return self._snapToLine(point, d)
+
+    def _snapToLine(self, point, d):
         snapped = False
         snap_point = None
         snap_idx = None
         if self.anchorCount() > 1:
-            geom = QgsGeometry.fromPolylineXY(self.points)
-            (dist, minDistPoint, afterVertex,
-             leftOf) = geom.closestSegmentWithContext(point)
-            if math.sqrt(dist) < d:
+            closest = self._closestSegment(point, d)
+            if closest is not None and math.sqrt(closest[0]) < d:
+                dist, minDistPoint, afterVertex = closest
                 snapped = True
                 snap_idx = afterVertex
-                snap_point = self._trans(minDistPoint, revert=True)
+                snap_point = self._trans(QgsPointXY(*minDistPoint), revert=True)
 
         return snapped, snap_point, snap_idx
 
     def checkSnapToStart(self, point, d):
         point = self._trans(point)
+        d = self._metersToWorking(d)
+        return self._snapToStart(point, d)
+
+    def _snapToStart(self, point, d):
         snapped = False
         snap_point = None
         snap_idx = None
@@ -547,59 +979,63 @@ class BezierGeometry:
         """
         do invert process from history
         """
+        # undo while drawing freehand line cancels the drawing
+        if self._stream is not None:
+            self.cancel_stream()
+            return len(self.history)
         if len(self.history) > 0:
             act = self.history.pop()
-            if act["state"] == "add_anchor":
-                self._deleteAnchor(act["pointidx"])
-            elif act["state"] == "move_anchor":
-                self._moveAnchor(act["pointidx"], act["point"])
-            elif act["state"] == "move_anchor2":
-                self._moveAnchor(act["pointidx"], act["point"])
-                self._moveAnchor(0, act["point"])
-            elif act["state"] == "move_handle":
-                self._moveHandle(act["pointidx"], act["point"])
-            elif act["state"] == "insert_anchor":
-                self._deleteAnchor(act["pointidx"])
-                self._moveHandle((act["pointidx"] - 1) *
-                                 2 + 1, act["ctrlpoint0"])
-                self._moveHandle((act["pointidx"] - 1) *
-                                 2 + 2, act["ctrlpoint1"])
-            elif act["state"] == "delete_anchor":
-                self._addAnchor(act["pointidx"], act["point"])
-                self._moveHandle(act["pointidx"] * 2, act["ctrlpoint0"])
-                self._moveHandle(act["pointidx"] * 2 + 1, act["ctrlpoint1"])
-            elif act["state"] == "delete_anchor2":
+            if act.state == "add_anchor":
+                self._deleteAnchor(act.pointidx)
+            elif act.state == "move_anchor":
+                self._moveAnchor(act.pointidx, act.point)
+            elif act.state == "move_anchor2":
+                self._moveAnchor(act.pointidx, act.point)
+                self._moveAnchor(0, act.point)
+            elif act.state == "move_handle":
+                self._moveHandle(act.pointidx, act.point)
+            elif act.state == "insert_anchor":
+                self._deleteAnchor(act.pointidx)
+                self._moveHandle((act.pointidx - 1) *
+                                 2 + 1, act.ctrlpoint0)
+                self._moveHandle((act.pointidx - 1) *
+                                 2 + 2, act.ctrlpoint1)
+            elif act.state == "delete_anchor":
+                self._addAnchor(act.pointidx, act.point)
+                self._moveHandle(act.pointidx * 2, act.ctrlpoint0)
+                self._moveHandle(act.pointidx * 2 + 1, act.ctrlpoint1)
+            elif act.state == "delete_anchor2":
                 self._deleteAnchor(self.anchorCount()-1)
-                self._addAnchor(0, act["point"])
-                self._moveHandle(1, act["ctrlpoint0"])
-                self._addAnchor(act["pointidx"], act["point"])
-                self._moveHandle(act["pointidx"] * 2, act["ctrlpoint1"])
-            elif act["state"] == "delete_handle":
-                self._moveHandle(act["pointidx"], act["point"])
-            elif act["state"] == "flip_line":
+                self._addAnchor(0, act.point)
+                self._moveHandle(1, act.ctrlpoint0)
+                self._addAnchor(act.pointidx, act.point)
+                self._moveHandle(act.pointidx * 2, act.ctrlpoint1)
+            elif act.state == "delete_handle":
+                self._moveHandle(act.pointidx, act.point)
+            elif act.state == "flip_line":
                 self._flipBezierLine()
                 self.undo()
-            elif act["state"] == "end_freehand":
-                direction = act["direction"]
+            elif act.state == "end_freehand":
+                direction = act.direction
                 if direction == "reverse":
                     self._flipBezierLine()
                 act = self.history.pop()
-                while act["state"] != "start_freehand":
-                    if act["state"] == "insert_geom":
-                        for i in range(act["pointnum"]):
-                            self._deleteAnchor(act["pointidx"])
-                        if act["cp_first"] is not None:
+                while act.state != "start_freehand":
+                    if act.state == "insert_geom":
+                        for i in range(act.pointnum):
+                            self._deleteAnchor(act.pointidx)
+                        if act.ctrlpoint0 is not None:
                             self._moveHandle(
-                                act["pointidx"] * 2 - 1, act["cp_first"])
-                        if act["cp_last"] is not None:
+                                act.pointidx * 2 - 1, act.ctrlpoint0)
+                        if act.ctrlpoint1 is not None:
                             self._moveHandle(
-                                act["pointidx"] * 2, act["cp_last"])
-                    elif act["state"] == "delete_anchor":
-                        self._addAnchor(act["pointidx"], act["point"])
+                                act.pointidx * 2, act.ctrlpoint1)
+                    elif act.state == "delete_anchor":
+                        self._addAnchor(act.pointidx, act.point)
                         self._moveHandle(
-                            act["pointidx"] * 2, act["ctrlpoint0"])
+                            act.pointidx * 2, act.ctrlpoint0)
                         self._moveHandle(
-                            act["pointidx"] * 2 + 1, act["ctrlpoint1"])
+                            act.pointidx * 2 + 1, act.ctrlpoint1)
                     act = self.history.pop()
                 if direction == "reverse":
                     self._flipBezierLine()
@@ -607,10 +1043,103 @@ class BezierGeometry:
         # self.dump_history()
         return len(self.history)
 
+    def _closestSegment(self, point, d):
+        """
+        return (squared distance, (x, y), afterVertex) of the closest segment of bezier line points
+        as QgsGeometry.closestSegmentWithContext. only segments within distance d are searched.
+        return None if there is no segment within d.
+        """
+        points = self.points.array()
+        offsets = self._segmentOffsets()
+        self._syncLineGrid()
+        x, y = point[0], point[1]
+        segs = self._lineGrid.candidates(
+            (x - d, y - d, x + d, y + d), d, lambda: self._segmentBoxes(np.arange(self.anchorCount() - 1)))
+        if not segs:
+            return None
+        segs = np.array(segs, dtype=np.int64)
+        boxes = self._segmentBoxes(segs)
+        segs = segs[(boxes[:, 0] <= x + d) & (boxes[:, 2] >= x - d) & (boxes[:, 1] <= y + d) & (boxes[:, 3] >= y - d)]
+        if len(segs) == 0:
+            return None
+        # first points of line segments in the bezier segments, in order
+        counts = offsets[segs + 1] - offsets[segs]
+        first = np.repeat(offsets[segs] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        x1, y1 = points[first, 0], points[first, 1]
+        dx, dy = points[first + 1, 0] - x1, points[first + 1, 1] - y1
+        # QgsGeometryUtils::sqrDistToLine
+        eps = 4 * np.finfo(np.float64).eps
+        line = ~((-eps < dx) & (dx <= eps) & (-eps < dy) & (dy <= eps))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = ((x - x1) * dx + (y - y1) * dy) / (dx * dx + dy * dy)
+        t = np.where(line, t, 0.0)
+        mx = np.where(t > 1, points[first + 1, 0], np.where(t > 0, x1 + dx * t, x1))
+        my = np.where(t > 1, points[first + 1, 1], np.where(t > 0, y1 + dy * t, y1))
+        ex, ey = x - mx, y - my
+        dist = ex * ex + ey * ey
+        i = int(np.argmin(dist))
+        # the point on the segment
+        if -1e-8 < dist[i] <= 1e-8:
+            return 0.0, (x, y), int(first[i]) + 1
+        return float(dist[i]), (float(mx[i]), float(my[i])), int(first[i]) + 1
+
+    def _segmentBoxes(self, segs):
+        """
+        return bounding boxes (k, 4) of control points of bezier segments. bezier line is in the box
+        """
+        anchors = self.anchor.array()
+        handles = self.handle.array()
+        ctrl = np.stack([anchors[segs], handles[segs * 2 + 1], handles[segs * 2 + 2], anchors[segs + 1]], axis=1)
+        return np.concatenate([ctrl.min(axis=1), ctrl.max(axis=1)], axis=1)
+
+    def _syncLineGrid(self):
+        """
+        update the index of bezier segments by changes after the last query
+        """
+        grid = self._lineGrid
+        changes = self.changesSince(self._lineGridVersion) if grid.isBuilt() else None
+        n = self._lineGridCount
+        touched = set()  # segment idx whose box is changed
+        for kind, idx in changes or []:
+            if kind == "add_anchor":
+                n += 1
+                if n < 2:
+                    continue
+                seg = min(idx, n - 2)
+                touched = {j + 1 if j >= seg else j for j in touched}
+                # the box is set below
+                grid.insert(seg, (0.0, 0.0, 0.0, 0.0))
+                touched.update(j for j in (idx - 1, idx) if 0 <= j <= n - 2)
+            elif kind == "delete_anchor":
+                n -= 1
+                if n < 1:
+                    continue
+                seg = min(idx, n - 1)
+                grid.delete(seg)
+                touched = {j - 1 if j > seg else j for j in touched if j != seg}
+                # two segments are merged
+                if 0 < idx < n:
+                    touched.add(idx - 1)
+            elif kind == "move_anchor":
+                touched.update(j for j in (idx - 1, idx) if 0 <= j <= n - 2)
+            elif kind == "move_handle":
+                if 0 <= (idx - 1) // 2 <= n - 2:
+                    touched.add((idx - 1) // 2)
+            if not grid.isBuilt():
+                break
+        if changes is None:
+            grid.clear()
+        elif grid.isBuilt() and touched:
+            segs = np.array(sorted(touched), dtype=np.int64)
+            for seg, box in zip(segs.tolist(), self._segmentBoxes(segs).tolist()):
+                grid.move(seg, box)
+        self._lineGridVersion = self.version
+        self._lineGridCount = self.anchorCount()
+
     def _eachPointIsNear(self, snap_point, point, d):
         near = False
-        if (snap_point.x() - d <= point.x() <= snap_point.x() + d) and (
-                snap_point.y() - d <= point.y() <= snap_point.y() + d):
+        if (snap_point[0] - d <= point[0] <= snap_point[0] + d) and (
+                snap_point[1] - d <= point[1] <= snap_point[1] + d):
             near = True
         return near
 
@@ -626,46 +1155,67 @@ class BezierGeometry:
         self._moveHandle((anchor_idx - 1) * 2 + 3, c1b)
         self._moveHandle((anchor_idx - 1) * 2 + 4, c2b)
 
+    def _fitTolerance(self, scale):
+        """
+        squared distance of fitCurve maxError in working CRS unit
+        """
+        # This expression returns the same point distance at any scale.
+        # This value was determined by a manual test.
+        # maxError is squared distance in meter, so it is converted to working CRS unit by squared factor.
+        return 25**(math.log(scale/2000, 5)) * self._unitFactor ** 2
+
     def _convertGeometryToBezier(self, geom, offset, scale, last=True):
         """
         convert geometry to anchor and handle list by fitCurve, then add it to bezier line
         if last=F, don't insert last point
         """
-        polyline = geom.asPolyline()
-        points = np.array(polyline)
-        # This expression returns the same point distance at any scale.
-        # This value was determined by a manual test.
-        maxError = 25**(math.log(scale/2000, 5))
-        beziers = fitCurve(points, maxError)
+        beziers = fitLine(np.array(geom.asPolyline()), self._fitTolerance(scale), self.FIT_ITERATION,
+                          self.FIT_CORNER_ANGLE, self.FIT_SIMPLIFY)
+        return self._insertBeziers(beziers, offset, last)
+
+    def _freehandEdit(self, polyline, offset, scale, snap_to_start, last=True, front=0):
+        edit = FreehandEdit(np.array(polyline, dtype=np.float64).reshape(-1, 2),
+                            (self._fitTolerance(scale), self.FIT_ITERATION, self.FIT_CORNER_ANGLE, self.FIT_SIMPLIFY))
+        edit.offset = offset
+        edit.last = last
+        edit.front = front
+        edit.snap_to_start = snap_to_start
+        return edit
+
+    def _insertBeziers(self, beziers, offset, last=True):
+        """
+        add fitted curves (k, 4, 2) to bezier line at anchor offset
+        if last=F, don't insert last point
+        """
         pointnum = 0
 
         if offset != 0:
-            cp_first = self.getHandle(offset * 2 - 1)
+            cp_first = self.handle.xy(offset * 2 - 1)
         else:
             cp_first = None
         if last == False:
-            cp_last = self.getHandle(offset * 2)
+            cp_last = self.handle.xy(offset * 2)
         else:
             cp_last = None
 
         for i, bezier in enumerate(beziers):
             if offset == 0:
                 if i == 0:
-                    p0 = QgsPointXY(bezier[0][0], bezier[0][1])
+                    p0 = bezier[0]
                     self._addAnchor(0, p0)
                     pointnum = pointnum + 1
-                p1 = QgsPointXY(bezier[3][0], bezier[3][1])
-                c1 = QgsPointXY(bezier[1][0], bezier[1][1])
-                c2 = QgsPointXY(bezier[2][0], bezier[2][1])
+                p1 = bezier[3]
+                c1 = bezier[1]
+                c2 = bezier[2]
                 self._moveHandle(i * 2 + 1, c1)
                 self._addAnchor(i + 1, p1)
                 self._moveHandle((i + 1) * 2, c2)
                 pointnum = pointnum + 1
 
             elif offset > 0:
-                p1 = QgsPointXY(bezier[3][0], bezier[3][1])
-                c1 = QgsPointXY(bezier[1][0], bezier[1][1])
-                c2 = QgsPointXY(bezier[2][0], bezier[2][1])
+                p1 = bezier[3]
+                c1 = bezier[1]
+                c2 = bezier[2]
                 idx = (offset - 1 + i) * 2 + 1
                 self._moveHandle(idx, c1)
 
@@ -682,210 +1232,298 @@ class BezierGeometry:
         """
         if idx == -1:
             idx = self.anchorCount()
+        num = self.anchorCount() + 1
+        start = self._pointsIdx(idx) if idx < num - 1 else len(self._points)
         self.anchor.insert(idx, point)
         self.handle.insert(idx * 2, point)
         self.handle.insert(idx * 2, point)
-        pointsA = []
-        pointsB = []
-        # calc bezier line of right side of the anchor.
-        if idx < self.anchorCount() - 1:
-            p1 = self.getAnchor(idx)
-            p2 = self.getAnchor(idx + 1)
-            c1 = self.getHandle(idx * 2 + 1)
-            c2 = self.getHandle(idx * 2 + 2)
-            pointsA = self._bezier(p1, c1, p2, c2)
-        # calc bezier line of left side of the anchor
-        if idx >= 1:
-            p1 = self.getAnchor(idx - 1)
-            p2 = self.getAnchor(idx)
-            c1 = self.getHandle(idx * 2 - 1)
-            c2 = self.getHandle(idx * 2)
-            pointsB = self._bezier(p1, c1, p2, c2)
-
+        self._anchorGrid.insert(idx, point)
+        self._handleGrid.insert(idx * 2, point)
+        self._handleGrid.insert(idx * 2, point)
         # first anchor
-        if idx == 0 and len(pointsA) == 0:
-            self.points = copy.copy(self.anchor)
-        # the case of undo that of polygon's first anchor delete
-        elif idx == 0 and len(pointsA) > 0:
-            self.points = pointsA[0:-1] + self.points
-        # second anchor
-        elif idx == 1 and idx == self.anchorCount() - 1:
-            self.points = pointsB
-        # third point and after
-        elif idx >= 2 and idx == self.anchorCount() - 1:
-            self.points = self.points + pointsB[1:]
-        # insert anchor
+        if num == 1:
+            self._points.assign(self.anchor.array())
+        # the segment of the inserted anchor is added, then points are recalculated on reading.
         else:
-            self.points[self._pointsIdx(
-                idx - 1):self._pointsIdx(idx) + 1] = pointsB + pointsA[1:]
+            k = self.INTERPOLATION
+            self._points.splice(start, start, np.repeat(toXY(point).reshape(1, 2), k, axis=0))
+            self._counts.insert(idx if idx < num - 1 else idx - 1, k)
+            self._countsChanged()
+            self._dirty = {j + 1 if j >= idx else j for j in self._dirty}
+            if idx >= 1:
+                self._dirty.add(idx - 1)
+            if idx < num - 1:
+                self._dirty.add(idx)
+        self._changed("add_anchor", idx)
 
     def _deleteAnchor(self, idx):
-        # first anchor
-        if idx == 0:
-            del self.points[0:self.INTERPOLATION]
-        # end anchor
-        elif idx + 1 == self.anchorCount():
-            del self.points[self._pointsIdx(idx - 1) + 1:]
+        num = self.anchorCount()
+        if num <= 2:
+            self._points.assign(np.delete(self.anchor.array(), idx, axis=0))
+            self._counts = []
+            self._dirty = set()
         else:
-            p1 = self.getAnchor(idx - 1)
-            p2 = self.getAnchor(idx + 1)
-            c1 = self.getHandle((idx - 1) * 2 + 1)
-            c2 = self.getHandle((idx + 1) * 2)
-            points = self._bezier(p1, c1, p2, c2)
-            self.points[self._pointsIdx(
-                idx - 1):self._pointsIdx(idx + 1) + 1] = points
+            # first anchor
+            if idx == 0:
+                self._points.delete(0, self._pointsIdx(1))
+                del self._counts[0]
+            # end anchor
+            elif idx + 1 == num:
+                self._points.delete(self._pointsIdx(idx - 1) + 1, len(self._points))
+                del self._counts[idx - 1]
+            # two segments of both sides are merged
+            else:
+                self._points.delete(self._pointsIdx(idx), self._pointsIdx(idx + 1))
+                del self._counts[idx]
+            self._dirty = {j - 1 if j > idx else j for j in self._dirty if j != idx}
+            if 0 < idx < num - 1:
+                self._dirty.add(idx - 1)
+            elif idx == num - 1:
+                self._dirty.discard(idx - 1)
+        self._countsChanged()
         self._delHandle(2 * idx)
         self._delHandle(2 * idx)
         self._delAnchor(idx)
+        self._changed("delete_anchor", idx)
 
         return
 
     def _moveAnchor(self, idx, point):
-        diff = point - self.getAnchor(idx)
+        point = toXY(point)
+        diff = point - self.anchor.xy(idx)
         self._setAnchor(idx, point)
-        self._setHandle(idx * 2, self.getHandle(idx * 2) + diff)
-        self._setHandle(idx * 2 + 1, self.getHandle(idx * 2 + 1) + diff)
+        self._setHandle(idx * 2, self.handle.xy(idx * 2) + diff)
+        self._setHandle(idx * 2 + 1, self.handle.xy(idx * 2 + 1) + diff)
         # if only one anchor
         if idx == 0 and self.anchorCount() == 1:
-            self.points = copy.copy(self.anchor)
+            self._points.assign(self.anchor.array())
         else:
-            # calc bezier line of right side of the anchor.
+            # bezier line of right side of the anchor.
             if idx < self.anchorCount() - 1:
-                p1 = self.getAnchor(idx)
-                p2 = self.getAnchor(idx + 1)
-                c1 = self.getHandle(idx * 2 + 1)
-                c2 = self.getHandle(idx * 2 + 2)
-                points = self._bezier(p1, c1, p2, c2)
-                self.points[self._pointsIdx(
-                    idx):self._pointsIdx(idx + 1) + 1] = points
-            # calc bezier line of left side of the anchor.
+                self._dirty.add(idx)
+            # bezier line of left side of the anchor.
             if idx >= 1:
-                p1 = self.getAnchor(idx - 1)
-                p2 = self.getAnchor(idx)
-                c1 = self.getHandle(idx * 2 - 1)
-                c2 = self.getHandle(idx * 2)
-                points = self._bezier(p1, c1, p2, c2)
-                self.points[self._pointsIdx(
-                    idx - 1):self._pointsIdx(idx) + 1] = points
+                self._dirty.add(idx - 1)
+        self._changed("move_anchor", idx)
 
     def _moveHandle(self, idx, point):
         self._setHandle(idx, point)
         if self.anchorCount() > 1:
             # right side handle
             if idx % 2 == 1 and idx < self._handleCount() - 1:
-                idxP = idx // 2
-                p1 = self.getAnchor(idxP)
-                p2 = self.getAnchor(idxP + 1)
-                c1 = self.getHandle(idx)
-                c2 = self.getHandle(idx + 1)
+                self._dirty.add(idx // 2)
             # left side handle
             elif idx % 2 == 0 and idx >= 1:
-                idxP = (idx - 1) // 2
-                p1 = self.getAnchor(idxP)
-                p2 = self.getAnchor(idxP + 1)
-                c1 = self.getHandle(idx - 1)
-                c2 = self.getHandle(idx)
-            else:
-                return
-            points = self._bezier(p1, c1, p2, c2)
-            self.points[self._pointsIdx(
-                idxP):self._pointsIdx(idxP + 1) + 1] = points
+                self._dirty.add((idx - 1) // 2)
+        self._changed("move_handle", idx)
+
+    @property
+    def points(self):
+        """
+        bezier line points. dirty segments are recalculated before reading.
+        """
+        self._flush()
+        return self._points
+
+    def _flush(self):
+        if self._dirty:
+            self._updateSegments()
+
+    def _updateSegments(self):
+        """
+        recalc bezier line points of dirty segments in one pass
+        """
+        segs = np.array(sorted(self._dirty), dtype=np.int64)
+        anchors = self.anchor.array()
+        handles = self.handle.array()
+        ctrl = np.stack([anchors[segs], handles[segs * 2 + 1], handles[segs * 2 + 2], anchors[segs + 1]], axis=1)
+        counts = self._segmentCounts(ctrl)
+        # resize segments whose interpolation count is changed. from the end not to shift the other segments
+        resized = np.flatnonzero(counts != np.array(self._counts, dtype=np.int64)[segs])
+        for i in resized[::-1]:
+            start = self._pointsIdx(segs[i])
+            self._points.splice(start + 1, start + self._counts[segs[i]], np.zeros((counts[i] - 1, 2)))
+        if len(resized):
+            for i in resized:
+                self._counts[segs[i]] = int(counts[i])
+            self._countsChanged()
+        offsets = self._segmentOffsets()
+        for n in np.unique(counts):
+            sel = counts == n
+            rows = offsets[segs[sel]][:, None] + np.arange(n + 1)
+            self._points.put(rows.ravel(), bezier.qn(ctrl[sel], n).reshape(-1, 2))
+        self._dirty = set()
+
+    def _segmentCounts(self, ctrl):
+        """
+        return interpolation count of segments defined by control points (k, 4, 2).
+        with INTERPOLATION_TOLERANCE, the count is the smallest uniform count that the distance
+        between the curve and the interpolated line is within the tolerance.
+        """
+        ctrl = np.asarray(ctrl, dtype=np.float64).reshape(-1, 4, 2)
+        if self.INTERPOLATION_TOLERANCE <= 0:
+            return np.full(len(ctrl), self.INTERPOLATION, dtype=np.int64)
+        # the distance is bounded by max|B''| / (8 n^2), max|B''| <= 6 max|P(i) - 2P(i+1) + P(i+2)|
+        second = ctrl[:, :-2] - 2 * ctrl[:, 1:-1] + ctrl[:, 2:]
+        m = np.hypot(second[..., 0], second[..., 1]).max(axis=1)
+        n = np.ceil(np.sqrt(0.75 * m / self._metersToWorking(self.INTERPOLATION_TOLERANCE)))
+        return np.clip(n, self.MIN_INTERPOLATION, self.MAX_INTERPOLATION).astype(np.int64)
+
+    def _segmentOffsets(self):
+        """
+        return points idx of each anchor
+        """
+        if self._offsets is None:
+            self._offsets = np.concatenate([[0], np.cumsum(self._counts, dtype=np.int64)])
+        return self._offsets
+
+    def _countsChanged(self):
+        self._offsets = None
+        self.layoutVersion += 1
+
+    def _changed(self, kind, idx=None):
+        """
+        record the change for consumers which update only changed parts. see changesSince.
+        """
+        self.version += 1
+        if kind == "reset":
+            self._anchorGrid.clear()
+            self._handleGrid.clear()
+            self._changes = []
+            self._fullVersion = self.version
+            return
+        self._changes.append((self.version, kind, idx))
+        if len(self._changes) > self.CHANGE_LOG_SIZE:
+            del self._changes[:len(self._changes) - self.CHANGE_LOG_SIZE]
+            self._fullVersion = self._changes[0][0] - 1
 
     def _recalcHandlePosition(self, point_idx, anchor_idx, pnt):
         """
         Recalculate handle positions on both sides from point list between anchors when adding anchors to Bezier curve
         """
+        points = self.points.array()
         bezier_idx = self._pointListIdx(point_idx)
+        pnt = toXY(pnt)
 
         # calc handle position of left size of anchor
         # If point counts of left side of insert point are 4 points or more, handle position can be recalculated .
         if 2 < bezier_idx:
-            pointsA = self.points[self._pointsIdx(
-                anchor_idx - 1):point_idx] + [pnt]
+            pointsA = np.vstack([points[self._pointsIdx(anchor_idx - 1):point_idx], pnt])
             ps, cs, pe, ce = self._convertPointListToAnchorAndHandle(pointsA)
-            c1a = QgsPointXY(cs[0], cs[1])
-            c2a = QgsPointXY(ce[0], ce[1])
+            c1a = cs
+            c2a = ce
         # If it is less than 4 points, make the position of the handle the same as the anchor.
         # and then connect with a straight line
         else:
-            c1a = self.points[self._pointsIdx(anchor_idx - 1)]
+            c1a = points[self._pointsIdx(anchor_idx - 1)].copy()
             c2a = pnt
         # calc handle position of right size of anchor
         # The way of thinking is the same as the left side
-        if self.INTERPOLATION - 1 > bezier_idx:
-            pointsB = [pnt] + \
-                self.points[point_idx:self._pointsIdx(anchor_idx) + 1]
+        if self._counts[anchor_idx - 1] - 1 > bezier_idx:
+            pointsB = np.vstack([pnt, points[point_idx:self._pointsIdx(anchor_idx) + 1]])
             ps, cs, pe, ce = self._convertPointListToAnchorAndHandle(
                 pointsB, type="B")
-            c1b = QgsPointXY(cs[0], cs[1])
-            c2b = QgsPointXY(ce[0], ce[1])
+            c1b = cs
+            c2b = ce
         else:
             c1b = pnt
-            c2b = self.points[self._pointsIdx(anchor_idx)]
+            c2b = points[self._pointsIdx(anchor_idx)].copy()
 
         return (c1a, c2a, c1b, c2b)
 
     def _bezier(self, p1, c1, p2, c2):
         """
-        Returns a list of Bezier line points defined by the start and end point anchors and handles
+        Returns an array of Bezier line points defined by the start and end point anchors and handles
         """
-        points = []
-        for t in range(0, self.INTERPOLATION + 1):
-            t = 1.0 * t / self.INTERPOLATION
-            bx = (1 - t) ** 3 * p1.x() + 3 * t * (1 - t) ** 2 * \
-                c1.x() + 3 * t ** 2 * (1 - t) * c2.x() + t ** 3 * p2.x()
-            by = (1 - t) ** 3 * p1.y() + 3 * t * (1 - t) ** 2 * \
-                c1.y() + 3 * t ** 2 * (1 - t) * c2.y() + t ** 3 * p2.y()
-            points.append(QgsPointXY(bx, by))
-        return points
+        ctrl = [(p1[0], p1[1]), (c1[0], c1[1]), (c2[0], c2[1]), (p2[0], p2[1])]
+        return bezier.qn(ctrl, self._segmentCounts(ctrl)[0])
 
-    def _invertBezierPointListToBezier(self, point_list):
-        """
-        invert from the Bezier pointList to anchor and handle coordinate
-        """
-        for i, points_i in enumerate(point_list):
-            ps, cs, pe, ce = self._convertPointListToAnchorAndHandle(points_i)
-            p0 = QgsPointXY(ps[0], ps[1])
-            p1 = QgsPointXY(pe[0], pe[1])
-            c0 = QgsPointXY(ps[0], ps[1])
-            c1 = QgsPointXY(cs[0], cs[1])
-            c2 = QgsPointXY(ce[0], ce[1])
-            c3 = QgsPointXY(pe[0], pe[1])
-            if i == 0:
-                self._addAnchor(-1, p0)
-                self._moveHandle(i * 2, c0)
-                self._moveHandle(i * 2 + 1, c1)
-                self._addAnchor(-1, p1)
-                self._moveHandle((i + 1) * 2, c2)
-                self._moveHandle((i + 1) * 2 + 1, c3)
-            else:
-                self._moveHandle(i * 2 + 1, c1)
-                self._addAnchor(-1, p1)
-                self._moveHandle((i + 1) * 2, c2)
-                self._moveHandle((i + 1) * 2 + 1, c3)
+    def _bezierPolyline(self, anchors, handles, counts=None):
+        """
+        Returns bezier line points of all segments defined by anchor array (N, 2) and handle array (2N, 2)
+        and interpolation count of each segment
+        """
+        if len(anchors) < 2:
+            return np.array(anchors, dtype=np.float64).reshape(-1, 2), []
+        ctrl = np.stack([anchors[:-1], handles[1:-1:2], handles[2::2], anchors[1:]], axis=1)
+        if counts is None:
+            counts = self._segmentCounts(ctrl)
+        counts = np.asarray(counts, dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        points = np.empty((offsets[-1] + 1, 2))
+        for n in np.unique(counts):
+            sel = np.flatnonzero(counts == n)
+            rows = offsets[sel][:, None] + np.arange(n + 1)
+            points[rows.ravel()] = bezier.qn(ctrl[sel], n).reshape(-1, 2)
+        return points, counts.tolist()
+
+    def _setBezier(self, anchors, handles, counts=None):
+        """
+        replace all anchors and handles, and regenerate bezier line points in one pass
+        """
+        self.anchor.assign(anchors)
+        self.handle.assign(handles)
+        points, self._counts = self._bezierPolyline(self.anchor.array(), self.handle.array(), counts)
+        self._points.assign(points)
+        self._countsChanged()
+        self._dirty = set()
+        self._changed("reset")
+
+    def _invertBezierLineToBezier(self, polyline, counts):
+        """
+        invert from the Bezier polyline to anchor and handle coordinate in one pass.
+        polyline is already the bezier line points, so it is used as it is without recalculation.
+        """
+        if len(counts) == 0:
+            return
+        polyline = np.asarray(polyline, dtype=np.float64).reshape(-1, 2)
+        offsets = np.concatenate([[0], np.cumsum(counts, dtype=np.int64)])
+        anchors = polyline[offsets]
+        handles = np.empty((2 * len(anchors), 2))
+        for segs, segments in self._segmentGroups(polyline, counts):
+            ps, cs, pe, ce = self._convertSegmentsToAnchorAndHandle(segments)
+            handles[segs * 2 + 1] = cs
+            handles[segs * 2 + 2] = ce
+        handles[0] = anchors[0]
+        handles[-1] = anchors[-1]
+        self.anchor.assign(anchors)
+        self.handle.assign(handles)
+        self._points.assign(polyline)
+        self._counts = list(counts)
+        self._countsChanged()
+        self._dirty = set()
+        self._changed("reset")
 
     def _convertPointListToAnchorAndHandle(self, points, type="A"):
         """
         convert to anchor and handle coordinate from the element of pointList
         the element of pointList is points between anchor to anchor
+        """
+        ps, c0, pe, c1 = self._convertSegmentsToAnchorAndHandle(
+            np.array(points, dtype=np.float64)[np.newaxis], type)
+        return ps[0], c0[0], pe[0], c1[0]
+
+    def _convertSegmentsToAnchorAndHandle(self, segments, type="A"):
+        """
+        convert to anchors and handles from segments points array (k, n + 1, 2) of the same interpolation count n
         it is solved the equation from the coordinates of t1 and t2
         type B solves a system of equations using the last two points. It is used for right side processing when inserting.
         """
 
-        ps = np.array(points[0])
-        pe = np.array(points[-1])
+        ps = segments[:, 0]
+        pe = segments[:, -1]
 
-        tnum = len(points) - 1
+        tnum = segments.shape[1] - 1
         if type == "A":
             t1 = 1.0 / tnum
-            p1 = np.array(points[1])
+            p1 = segments[:, 1]
             t2 = 2.0 / tnum
-            p2 = np.array(points[2])
+            p2 = segments[:, 2]
         elif type == "B":
             t1 = (tnum - 1) / tnum
-            p1 = np.array(points[-2])
+            p1 = segments[:, -2]
             t2 = (tnum - 2) / tnum
-            p2 = np.array(points[-3])
+            p2 = segments[:, -3]
 
         aa = 3 * t1 * (1 - t1) ** 2
         bb = 3 * t1 ** 2 * (1 - t1)
@@ -900,52 +1538,81 @@ class BezierGeometry:
     def _flipBezierLine(self):
         self.anchor.reverse()
         self.handle.reverse()
-        self.points.reverse()
+        self._points.reverse()
+        self._counts.reverse()
+        self._countsChanged()
+        self._dirty = {self.anchorCount() - 2 - j for j in self._dirty}
+        self._changed("reset")
 
     def _lineToInterpolatePointList(self, polyline):
 
         return [self._bezier(polyline[i], polyline[i], polyline[i+1], polyline[i+1]) for i in range(0, len(polyline)-1)]
 
-    def _lineToPointList(self, polyline):
+    def _lineToPointList(self, polyline, counts=None):
         """
         convert to pointList from polyline. pointList is points list between anchor to anchor
-        The number of elements in pointList is INTERPOLATION + 1 because each anchor overlaps.
+        The number of elements in pointList is interpolation count + 1 because each anchor overlaps.
+        counts is interpolation count of each segment of polyline. if it is None, counts of this bezier line is used.
         """
-        return [polyline[i:i + self.INTERPOLATION + 1] for i in range(0, len(polyline), self.INTERPOLATION)][:-1]
+        if counts is None:
+            counts = self._counts
+        offsets = np.concatenate([[0], np.cumsum(counts, dtype=np.int64)]).tolist()
+        return [polyline[offsets[i]:offsets[i + 1] + 1] for i in range(len(counts))]
+
+    def _segmentGroups(self, polyline, counts):
+        """
+        yield segment idx and points array (k, n + 1, 2) of segments for each interpolation count n
+        """
+        counts = np.asarray(counts, dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        for n in np.unique(counts):
+            segs = np.flatnonzero(counts == n)
+            yield segs, polyline[offsets[segs][:, np.newaxis] + np.arange(n + 1)]
 
     def _pointListIdx(self, point_idx):
         """
         convert to pointList idx  from bezier line points idx
         """
-        return (point_idx - 1) % self.INTERPOLATION + 1
+        return point_idx - self._pointsIdx(self._AnchorIdx(point_idx) - 1)
 
     def _pointsIdx(self, anchor_idx):
         """
         convert to bezier line points idx from anchor idx
         """
-        return anchor_idx * self.INTERPOLATION
+        return int(self._segmentOffsets()[anchor_idx])
 
     def _AnchorIdx(self, point_idx):
         """
         convert to bezier anchor idx from bezier line points idx
         It is the first anchor behind point.
         """
-        return (point_idx - 1) // self.INTERPOLATION + 1
+        return int(np.searchsorted(self._segmentOffsets(), point_idx))
+
+    def _isClosed(self):
+        points = self.points.array()
+        return len(points) >= 1 and np.array_equal(points[0], points[-1])
+
+    def _newStorage(self):
+        return STORAGES[self.STORAGE]()
 
     def _setAnchor(self, idx, point):
-        self.anchor[idx] = point
+        self.anchor.set(idx, point)
+        self._anchorGrid.move(idx, point)
 
     def _delAnchor(self, idx):
-        del self.anchor[idx]
+        self.anchor.delete(idx)
+        self._anchorGrid.delete(idx)
 
     def _handleCount(self):
         return len(self.handle)
 
     def _setHandle(self, idx, point):
-        self.handle[idx] = point
+        self.handle.set(idx, point)
+        self._handleGrid.move(idx, point)
 
     def _delHandle(self, idx):
-        del self.handle[idx]
+        self.handle.delete(idx)
+        self._handleGrid.delete(idx)
 
     def _closestAnchorOfGeometry(self, point, geom, d):
         """
@@ -972,16 +1639,15 @@ class BezierGeometry:
         poly_smooth = [QgsPointXY(x, y) for x, y in zip(x_smooth, y_smooth)]
         return poly_smooth
 
-    def _smoothingGeometry(self, polyline):
+    def _metersToWorking(self, d):
         """
-        convert polyline to smoothing geometry
+        convert distance in meter to working CRS unit
         """
-        #polyline = self._smoothing(polyline)
-        geom = QgsGeometry.fromPolylineXY(polyline)
-        smooth_geom = geom.smooth()
-        return smooth_geom
+        return d * self._unitFactor
 
     def _trans(self, p, revert=False):
+        if self._identity:
+            return QgsPointXY(p)
         if self.projectCRS.projectionAcronym() == "longlat" and revert == False:
             # check latitude exceeded limits
             if p.y() > 90:
@@ -989,33 +1655,56 @@ class BezierGeometry:
             elif p.y() < -90:
                 p = QgsPointXY(p.x(), -89.9999999)
 
-        destCrs = QgsCoordinateReferenceSystem("EPSG:3857")
-        if revert:
-            tr = QgsCoordinateTransform(
-                destCrs, self.projectCRS, QgsProject.instance())
-        else:
-            tr = QgsCoordinateTransform(
-                self.projectCRS, destCrs, QgsProject.instance())
-        p = tr.transform(p)
+        p = self._transform(revert).transform(p)
         return p
 
+    def _transArray(self, xys, revert=False):
+        """
+        transform coordinate array (N, 2) in one call instead of one call per point
+        """
+        xys = np.array(xys, dtype=np.float64).reshape(-1, 2)
+        if len(xys) == 0 or self._identity:
+            return xys
+        if self.projectCRS.projectionAcronym() == "longlat" and revert == False:
+            # check latitude exceeded limits
+            y = xys[:, 1]
+            y[y > 90] = 89.9999999
+            y[y < -90] = -89.9999999
+        line = QgsLineString(xys[:, 0].tolist(), xys[:, 1].tolist())
+        line.transform(self._transform(revert))
+        return np.column_stack([line.xVector(), line.yVector()])
+
     def _transgeom(self, geom, revert=False):
         g = QgsGeometry(geom)
-        destCrs = QgsCoordinateReferenceSystem("EPSG:3857")
-        if revert:
-            tr = QgsCoordinateTransform(
-                destCrs, self.projectCRS, QgsProject.instance())
-        else:
-            tr = QgsCoordinateTransform(
-                self.projectCRS, destCrs, QgsProject.instance())
-        g.transform(tr)
+        if not self._identity:
+            g.transform(self._transform(revert))
         return g
 
+    def _transform(self, revert=False):
+        """
+        return cached QgsCoordinateTransform between project CRS and working CRS
+        """
+        key = (self.projectCRS.authid(), self.workingCRS.authid(), revert)
+        tr = self._transforms.get(key)
+        if tr is None:
+            destCrs = self.workingCRS
+            context = self.TRANSFORM_CONTEXT
+            if context is None:
+                context = QgsProject.instance().transformContext()
+            if revert:
+                tr = QgsCoordinateTransform(
+                    destCrs, self.projectCRS, context)
+            else:
+                tr = QgsCoordinateTransform(
+                    self.projectCRS, destCrs, context)
+            self._transforms[key] = tr
+        return tr
+
     # for debug
     def dump_history(self):
         self.log("##### history dump ######")
         for h in self.history:
-            self.log("{}".format(h.items()))
+            self.log("{}".format(h))
         self.log("#####      end     ######")
 
     def log(self, msg):
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+""""
+/***************************************************************************
+    BezierEditing
+     --------------------------------------
+    Date                 : 01 05 2019
+    Copyright            : (C) 2019 Takayuki Mizutani
+    Email                : mizutani at ecoris dot co dot jp
+ ***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from collections import deque
+
+
+def toTuple(p):
+    """
+    return a copy of point as (x, y) float tuple. None is returned as it is.
+    """
+    if p is None:
+        return None
+    return (float(p[0]), float(p[1]))
+
+
+class HistoryRecord:
+    """
+    undo history record. points are (x, y) tuples of working CRS.
+    ctrlpoint0 and ctrlpoint1 are cp_first and cp_last for insert_geom.
+    """
+    __slots__ = ("state", "pointidx", "point", "ctrlpoint0", "ctrlpoint1", "pointnum", "direction")
+
+    def __init__(self, state, pointidx=None, point=None, ctrlpoint0=None, ctrlpoint1=None, pointnum=0, direction=None):
+        self.state = state
+        self.pointidx = pointidx
+        self.point = toTuple(point)
+        self.ctrlpoint0 = toTuple(ctrlpoint0)
+        self.ctrlpoint1 = toTuple(ctrlpoint1)
+        self.pointnum = pointnum
+        self.direction = direction
+
+    def __repr__(self):
+        return "HistoryRecord({})".format(", ".join(
+            "{}={}".format(k, getattr(self, k)) for k in self.__slots__ if getattr(self, k) is not None))
+
+
+class BezierHistory:
+    """
+    bounded undo history.
+    the oldest records are evicted over DEPTH. records from start_freehand to end_freehand are evicted together.
+    after eviction, empty history isn't the original state any more, so evicted is True.
+    a drag of an anchor or handle is recorded once at the press, so moves aren't coalesced.
+    """
+    DEPTH = 1000  # max count of records
+
+    def __init__(self):
+        self._records = deque()
+        self._open = 0  # count of freehand records not ended
+        self.evicted = False  # some records are evicted
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def append(self, record):
+        self._records.append(record)
+        if record.state == "start_freehand":
+            self._open += 1
+        elif record.state == "end_freehand":
+            self._open -= 1
+        # don't evict while freehand records are added
+        if self._open == 0:
+            self._evict()
+
+    def pop(self):
+        record = self._records.pop()
+        if record.state == "start_freehand":
+            self._open -= 1
+        elif record.state == "end_freehand":
+            self._open += 1
+        return record
+
+    def last(self):
+        return self._records[-1]
+
+    def _evict(self):
+        # DEPTH less than 1 is 1
+        depth = self.DEPTH if self.DEPTH > 1 else 1
+        while len(self._records) > depth:
+            if self._records[0].state == "start_freehand":
+                # group size. the last group is kept even if it is over DEPTH
+                size = 1
+                while self._records[size - 1].state != "end_freehand":
+                    size += 1
+                if size == len(self._records):
+                    return
+                for i in range(size):
+                    self._records.popleft()
+            else:
+                self._records.popleft()
+            self.evicted = True
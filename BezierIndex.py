@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+""""
+/***************************************************************************
+    BezierEditing
+     --------------------------------------
+    Date                 : 01 05 2019
+    Copyright            : (C) 2019 Takayuki Mizutani
+    Email                : mizutani at ecoris dot co dot jp
+ ***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import math
+
+import numpy as np
+from qgis.core import QgsFeature, QgsFeatureRequest, QgsGeometry, QgsSpatialIndex
+
+
+class BoxGrid:
+    """
+    uniform grid index of boxes (xmin, ymin, xmax, ymax) by list idx.
+    it is updated with the list by insert, delete and move, and built at the first query after clear.
+    cell size is decided by the query distance at building, and it is built again if the distance is changed much
+    by zooming. boxes over SPAN_LIMIT cells are not put in cells and they are always candidates.
+    """
+    SHIFT_LIMIT = 64  # max count of items whose idx is shifted by insert or delete. over this, built again
+    SPAN_LIMIT = 16  # max count of cells of a box in each axis
+
+    def __init__(self):
+        self._cells = None  # cell (ix, iy) to set of idx. None is not built
+        self._keys = []  # cell range (ix0, iy0, ix1, iy1) of each idx. None is a large box
+        self._large = set()  # idx of large boxes
+        self._size = 1.0  # cell size
+        self._d = 0.0  # query distance at building
+
+    def clear(self):
+        """
+        all items are changed. it is built at the next query
+        """
+        self._cells = None
+        self._keys = []
+        self._large = set()
+
+    def insert(self, idx, box):
+        if self._cells is None:
+            return
+        n = len(self._keys)
+        if n - idx > self.SHIFT_LIMIT:
+            self.clear()
+            return
+        for i in range(n - 1, idx - 1, -1):
+            self._remove(i, self._keys[i])
+            self._add(i + 1, self._keys[i])
+        key = self._range(box)
+        self._keys.insert(idx, key)
+        self._add(idx, key)
+
+    def delete(self, idx):
+        if self._cells is None:
+            return
+        n = len(self._keys)
+        if n - idx > self.SHIFT_LIMIT:
+            self.clear()
+            return
+        self._remove(idx, self._keys.pop(idx))
+        for i in range(idx, n - 1):
+            self._remove(i + 1, self._keys[i])
+            self._add(i, self._keys[i])
+
+    def move(self, idx, box):
+        if self._cells is None:
+            return
+        key = self._range(box)
+        if key != self._keys[idx]:
+            self._remove(idx, self._keys[idx])
+            self._keys[idx] = key
+            self._add(idx, key)
+
+    def isBuilt(self):
+        return self._cells is not None
+
+    def candidates(self, box, d, boxes):
+        """
+        return idx of boxes which may intersect box, in ascending order.
+        d is the query distance deciding cell size. boxes() returns (N, 4) array of all boxes to build the grid.
+        """
+        if self._cells is None or not (self._d / 2 <= d <= self._d * 2):
+            self._build(boxes(), d)
+        # margin for rounding of the bounds
+        e = self._size * 1e-9
+        x0, y0, x1, y1 = self._cellRange((box[0] - e, box[1] - e, box[2] + e, box[3] + e))
+        found = set(self._large)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > len(self._cells):
+            for (ix, iy), cell in self._cells.items():
+                if x0 <= ix <= x1 and y0 <= iy <= y1:
+                    found.update(cell)
+        else:
+            for ix in range(x0, x1 + 1):
+                for iy in range(y0, y1 + 1):
+                    cell = self._cells.get((ix, iy))
+                    if cell:
+                        found.update(cell)
+        return sorted(found)
+
+    def _cellSize(self, boxes, d):
+        # extent of the most boxes is in a cell
+        extent = np.maximum(boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1])
+        size = max(d, float(np.median(extent))) if len(extent) else d
+        return size if size > 0 else 1.0
+
+    def _build(self, boxes, d):
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        self._d = d
+        self._size = self._cellSize(boxes, d)
+        keys = np.floor(boxes / self._size).astype(np.int64).tolist()
+        self._keys = []
+        self._cells = {}
+        self._large = set()
+        for i, (x0, y0, x1, y1) in enumerate(keys):
+            key = None if max(x1 - x0, y1 - y0) >= self.SPAN_LIMIT else (x0, y0, x1, y1)
+            self._keys.append(key)
+            self._add(i, key)
+
+    def _cellRange(self, box):
+        return (math.floor(box[0] / self._size), math.floor(box[1] / self._size),
+                math.floor(box[2] / self._size), math.floor(box[3] / self._size))
+
+    def _range(self, box):
+        # cell range of a box, or None if it is large
+        x0, y0, x1, y1 = self._cellRange(box)
+        if max(x1 - x0, y1 - y0) >= self.SPAN_LIMIT:
+            return None
+        return (x0, y0, x1, y1)
+
+    def _add(self, idx, key):
+        if key is None:
+            self._large.add(idx)
+            return
+        x0, y0, x1, y1 = key
+        for ix in range(x0, x1 + 1):
+            for iy in range(y0, y1 + 1):
+                self._cells.setdefault((ix, iy), set()).add(idx)
+
+    def _remove(self, idx, key):
+        if key is None:
+            self._large.discard(idx)
+            return
+        x0, y0, x1, y1 = key
+        for ix in range(x0, x1 + 1):
+            for iy in range(y0, y1 + 1):
+                cell = self._cells[(ix, iy)]
+                cell.discard(idx)
+                if not cell:
+                    del self._cells[(ix, iy)]
+
+
+class PointGrid(BoxGrid):
+    """
+    uniform grid index of points by list idx, for snapping to anchors and handles.
+    cell size is the snap distance of the query.
+    """
+
+    def insert(self, idx, p):
+        super().insert(idx, (p[0], p[1], p[0], p[1]))
+
+    def move(self, idx, p):
+        super().move(idx, (p[0], p[1], p[0], p[1]))
+
+    def candidates(self, xys, point, d):
+        """
+        return idx of points which may be in the square of distance d from point, in descending order.
+        xys is (N, 2) array of all points, used to build the grid.
+        """
+        box = (point[0] - d, point[1] - d, point[0] + d, point[1] + d)
+        found = super().candidates(box, d, lambda: np.tile(np.asarray(xys, dtype=np.float64).reshape(-1, 2), 2))
+        found.reverse()
+        return found
+
+    def _cellSize(self, boxes, d):
+        return d if d > 0 else 1.0
+
+
+class FeatureIndex:
+    """
+    spatial index of features of each vector layer, to find features near the mouse without a request
+    to the data provider. the index of a layer is built at the first query with geometries only,
+    and updated by the signals of added, deleted and changed features of the edit buffer.
+    it is dropped when the features of the data provider are changed by commit, rollback or filter.
+    layers having more features than LIMIT or unknown count aren't indexed and requested by rectangle every time.
+    """
+    LIMIT = 100000  # max count of features of indexed layer
+
+    def __init__(self):
+        self._indexes = {}  # layer id to (QgsSpatialIndex, bounding box of each feature id)
+        self._slots = {}  # layer id to (layer, slots) connected to the layer signals
+
+    def ids(self, layer, rect, build=True):
+        """
+        return ids of features whose bounding box intersects rect in layer CRS.
+        if build is False, the index isn't built for this query, and it is used only if it is already built.
+        """
+        lid = layer.id()
+        if lid not in self._indexes:
+            count = layer.featureCount()
+            if not build or count < 0 or count > self.LIMIT:
+                request = QgsFeatureRequest().setFilterRect(rect).setNoAttributes()
+                request.setFlags(request.flags() | QgsFeatureRequest.NoGeometry)
+                return [f.id() for f in layer.getFeatures(request)]
+            if lid not in self._slots:
+                self._connect(layer)
+            self._build(layer)
+        return self._indexes[lid][0].intersects(rect)
+
+    def invalidate(self, lid):
+        self._indexes.pop(lid, None)
+
+    def clear(self):
+        for lid in list(self._slots):
+            self._disconnect(lid)
+        self._indexes = {}
+
+    def _build(self, layer):
+        index = QgsSpatialIndex()
+        bounds = {}
+        for f in layer.getFeatures(QgsFeatureRequest().setNoAttributes()):
+            if f.hasGeometry():
+                bounds[f.id()] = f.geometry().boundingBox()
+                index.addFeature(f.id(), bounds[f.id()])
+        self._indexes[layer.id()] = (index, bounds)
+
+    def _insert(self, lid, fid, geom):
+        index, bounds = self._indexes[lid]
+        if geom is not None and not geom.isNull():
+            bounds[fid] = geom.boundingBox()
+            index.addFeature(fid, bounds[fid])
+
+    def _delete(self, lid, fid):
+        index, bounds = self._indexes[lid]
+        box = bounds.pop(fid, None)
+        if box is not None:
+            # deleteFeature finds the entry by the bounding box of the geometry
+            f = QgsFeature(fid)
+            f.setGeometry(QgsGeometry.fromRect(box))
+            index.deleteFeature(f)
+
+    def _signals(self, layer):
+        # signals changing the features of the data provider
+        return (layer.afterCommitChanges, layer.afterRollBack, layer.subsetStringChanged, layer.dataSourceChanged)
+
+    def _connect(self, layer):
+        lid = layer.id()
+
+        def added(fid):
+            if lid in self._indexes:
+                f = next(layer.getFeatures(QgsFeatureRequest(fid).setNoAttributes()), None)
+                self._insert(lid, fid, f.geometry() if f is not None else None)
+
+        def deleted(fid):
+            if lid in self._indexes:
+                self._delete(lid, fid)
+
+        def changed(fid, geom):
+            if lid in self._indexes:
+                self._delete(lid, fid)
+                self._insert(lid, fid, geom)
+
+        def reset(*args):
+            self.invalidate(lid)
+
+        def removed():
+            self._disconnect(lid)
+
+        slots = ((layer.featureAdded, added), (layer.featureDeleted, deleted), (layer.geometryChanged, changed),
+                 (layer.willBeDeleted, removed)) + tuple((signal, reset) for signal in self._signals(layer))
+        for signal, slot in slots:
+            signal.connect(slot)
+        self._slots[lid] = (layer, slots)
+
+    def _disconnect(self, lid):
+        layer, slots = self._slots.pop(lid)
+        self._indexes.pop(lid, None)
+        try:
+            for signal, slot in slots:
+                signal.disconnect(slot)
+        except (RuntimeError, TypeError):
+            # the layer is already deleted
+            pass
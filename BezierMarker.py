@@ -28,6 +28,8 @@ class BezierMarker:
         self.anchor_marks = []  # anchor marker list
         self.handle_marks = []  # handle marker list
         self.handle_rbls = []  # handle line list
+        self.version = None  # version of bezier geometry which is shown
+        self.layoutVersion = None  # layout version of bezier geometry which bezier line is made
 
         # bezier curve line
         self.bezier_rbl = QgsRubberBand(self.canvas, QgsWkbTypes.LineGeometry)
@@ -60,7 +62,65 @@ class BezierMarker:
         for idx, point in enumerate(self.bg.getHandleList(revert=True)):
             self.handle_rbls[idx].movePoint(1, point, 0)
             self.handle_marks[idx].setCenter(point)
-        self._setBezierLine(self.bg.getPointList(revert=True), self.bezier_rbl)
+        self._resetBezierLine()
+        self.version = self.bg.version
+
+        if show_handle is not None:
+            self.show_handle(show_handle)
+
+    def update(self, show_handle=None):
+        """
+        update only markers and bezier curve changed since last shown
+        """
+        changes = None if self.version is None else self.bg.changesSince(self.version)
+        if changes is None:
+            self.show(show_handle)
+            return
+        anchors = set()  # anchor idx to be moved
+        handles = set()  # handle idx to be moved
+        structure = False  # anchor is added or deleted
+        for kind, idx in changes:
+            if kind == "add_anchor":
+                point = QgsPointXY()  # moved to the anchor position below
+                self._setAnchorHandleMarker(self.anchor_marks, idx, point)
+                self._setAnchorHandleMarker(self.handle_marks, 2 * idx, point, QColor(125, 125, 125))
+                self._setAnchorHandleMarker(self.handle_marks, 2 * idx, point, QColor(125, 125, 125))
+                self._setHandleLine(self.handle_rbls, 2 * idx, point)
+                self._setHandleLine(self.handle_rbls, 2 * idx, point)
+                anchors = {a + 1 if a >= idx else a for a in anchors}
+                anchors.add(idx)
+                handles = {h + 2 if h >= 2 * idx else h for h in handles}
+                structure = True
+            elif kind == "delete_anchor":
+                self._removeMarker(self.handle_marks, 2 * idx)
+                self._removeRubberBand(self.handle_rbls, 2 * idx)
+                self._removeMarker(self.handle_marks, 2 * idx)
+                self._removeRubberBand(self.handle_rbls, 2 * idx)
+                self._removeMarker(self.anchor_marks, idx)
+                anchors = {a - 1 if a > idx else a for a in anchors if a != idx}
+                handles = {h - 2 if h > 2 * idx + 1 else h for h in handles if h // 2 != idx}
+                structure = True
+            elif kind == "move_anchor":
+                anchors.add(idx)
+            elif kind == "move_handle":
+                handles.add(idx)
+
+        segments = set()
+        for idx in anchors:
+            handles.update((idx * 2, idx * 2 + 1))
+            self.anchor_marks[idx].setCenter(self.bg.getAnchor(idx, revert=True))
+        for idx in handles:
+            anchor = self.bg.getAnchor(idx // 2, revert=True)
+            point = self.bg.getHandle(idx, revert=True)
+            self.handle_marks[idx].setCenter(point)
+            self.handle_rbls[idx].movePoint(0, anchor, 0)
+            self.handle_rbls[idx].movePoint(1, point, 0)
+            segments.add((idx - 1) // 2)
+        if structure:
+            self._resetBezierLine()
+        else:
+            self._updateBezierLine(segments)
+        self.version = self.bg.version
 
         if show_handle is not None:
             self.show_handle(show_handle)
@@ -74,7 +134,8 @@ class BezierMarker:
         self._setAnchorHandleMarker(self.handle_marks, 2 * idx, point, QColor(125, 125, 125))
         self._setHandleLine(self.handle_rbls, 2 * idx, point)
         self._setHandleLine(self.handle_rbls, 2 * idx, point)
-        self._setBezierLine(self.bg.getPointList(revert=True), self.bezier_rbl)
+        self._resetBezierLine()
+        self.version = self.bg.version
 
     # アンカーを削除してベジエ曲線の表示を更新
     def delete_anchor(self, idx):
@@ -86,7 +147,8 @@ class BezierMarker:
         self._removeMarker(self.handle_marks, 2 * idx)
         self._removeRubberBand(self.handle_rbls, 2 * idx)
         self._removeMarker(self.anchor_marks, idx)
-        self._setBezierLine(self.bg.getPointList(revert=True), self.bezier_rbl)
+        self._resetBezierLine()
+        self.version = self.bg.version
 
     # アンカーを移動してベジエ曲線の表示を更新
     def move_anchor(self, idx, point):
@@ -100,7 +162,8 @@ class BezierMarker:
         self.handle_rbls[idx * 2 + 1].movePoint(0, point, 0)
         self.handle_rbls[idx * 2].movePoint(1, self.bg.getHandle(idx * 2,revert=True), 0)
         self.handle_rbls[idx * 2 + 1].movePoint(1, self.bg.getHandle(idx * 2 + 1,revert=True), 0)
-        self._setBezierLine(self.bg.getPointList(revert=True), self.bezier_rbl)
+        self._updateBezierLine([idx - 1, idx])
+        self.version = self.bg.version
 
     def move_handle(self, idx, point):
         """"
@@ -108,7 +171,8 @@ class BezierMarker:
         """
         self.handle_rbls[idx].movePoint(1, point, 0)
         self.handle_marks[idx].setCenter(point)
-        self._setBezierLine(self.bg.getPointList(revert=True), self.bezier_rbl)
+        self._updateBezierLine([(idx - 1) // 2])
+        self.version = self.bg.version
 
     def show_handle(self, show):
         """
@@ -128,6 +192,24 @@ class BezierMarker:
             update = point is points[-1]
             rbl.addPoint(point, update)
 
+    def _resetBezierLine(self):
+        self._setBezierLine(self.bg.getPointList(revert=True), self.bezier_rbl)
+        self.layoutVersion = self.bg.layoutVersion
+
+    def _updateBezierLine(self, segments):
+        # move only points of changed segments if interpolation counts of segments aren't changed.
+        # a single anchor has no segment, so the line is the anchor itself.
+        rbl = self.bezier_rbl
+        if rbl.numberOfVertices() != self.bg.pointCount() or self.layoutVersion != self.bg.layoutVersion \
+                or self.bg.anchorCount() < 2:
+            self._resetBezierLine()
+            return
+        for seg in sorted(set(segments)):
+            if 0 <= seg < self.bg.anchorCount() - 1:
+                start, points = self.bg.getSegmentPointList(seg, revert=True)
+                for i, point in enumerate(points):
+                    rbl.movePoint(start + i, point, 0)
+
     def _setAnchorHandleMarker(self, markers, idx, point, color=QColor(0, 0, 0)):
         # insert anchor or handle marker
         marker = QgsVertexMarker(self.canvas)
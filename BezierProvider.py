@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+""""
+/***************************************************************************
+    BezierEditing
+     --------------------------------------
+    Date                 : 01 05 2019
+    Copyright            : (C) 2019 Takayuki Mizutani
+    Email                : mizutani at ecoris dot co dot jp
+ ***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from qgis.PyQt.QtCore import *
+from qgis.PyQt.QtGui import *
+from qgis.core import *
+
+from .BezierAlgorithms import ConvertToBezierAlgorithm, DensifyAsBezierAlgorithm, CheckBezierAlgorithm
+
+
+class BezierProvider(QgsProcessingProvider):
+    """
+    processing provider of bezier conversion algorithms
+    """
+
+    def loadAlgorithms(self):
+        self.addAlgorithm(ConvertToBezierAlgorithm())
+        self.addAlgorithm(DensifyAsBezierAlgorithm())
+        self.addAlgorithm(CheckBezierAlgorithm())
+
+    def id(self):
+        return "bezierediting"
+
+    def name(self):
+        return self.tr("Bezier Editing")
+
+    def icon(self):
+        return QIcon(":/plugins/BezierEditing/icon/beziericon.svg")
+
+    def tr(self, message):
+        return QCoreApplication.translate("BezierEditing", message)
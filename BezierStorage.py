@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+""""
+/***************************************************************************
+    BezierEditing
+     --------------------------------------
+    Date                 : 01 05 2019
+    Copyright            : (C) 2019 Takayuki Mizutani
+    Email                : mizutani at ecoris dot co dot jp
+ ***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from qgis.core import QgsPointXY
+import numpy as np
+
+
+def toXY(p):
+    """
+    return a copy of point (QgsPointXY, tuple or array row) as float64 array of shape (2,)
+    """
+    return np.array((p[0], p[1]), dtype=np.float64)
+
+
+def toPointList(xys):
+    """
+    convert (N, 2) coordinates to QgsPointXY list
+    """
+    return [QgsPointXY(x, y) for x, y in np.asarray(xys, dtype=np.float64).reshape(-1, 2).tolist()]
+
+
+class PointArray:
+    """
+    point storage in contiguous float64 (N, 2) array with slack capacity.
+    QgsPointXY objects are created only by point() and points().
+    """
+    MIN_CAPACITY = 16
+
+    def __init__(self, xys=None):
+        self._buf = np.empty((self.MIN_CAPACITY, 2), dtype=np.float64)
+        self._n = 0
+        if xys is not None:
+            self.assign(xys)
+
+    def __len__(self):
+        return self._n
+
+    def _index(self, idx):
+        if idx < 0:
+            idx += self._n
+        if not 0 <= idx < self._n:
+            raise IndexError("point index out of range")
+        return idx
+
+    def _reserve(self, n):
+        # grow geometrically, shrink when mostly unused
+        cap = len(self._buf)
+        if n > cap:
+            cap = max(n, cap * 2)
+        elif cap > self.MIN_CAPACITY and n < cap // 4:
+            cap = max(self.MIN_CAPACITY, n * 2)
+        else:
+            return
+        buf = np.empty((cap, 2), dtype=np.float64)
+        buf[:self._n] = self._buf[:self._n]
+        self._buf = buf
+
+    def xy(self, idx):
+        return self._buf[self._index(idx)].copy()
+
+    def point(self, idx):
+        x, y = self._buf[self._index(idx)]
+        return QgsPointXY(x, y)
+
+    def points(self):
+        return toPointList(self._buf[:self._n])
+
+    def array(self):
+        """
+        return a view of stored coordinates. it is invalid after the next modification.
+        """
+        return self._buf[:self._n]
+
+    def set(self, idx, p):
+        self._buf[self._index(idx)] = (p[0], p[1])
+
+    def put(self, indices, xys):
+        """
+        overwrite points at indices with xys
+        """
+        self._buf[:self._n][indices] = xys
+
+    def insert(self, idx, p):
+        self.splice(idx, idx, toXY(p).reshape(1, 2))
+
+    def splice(self, start, stop, xys):
+        """
+        replace points[start:stop] with xys
+        """
+        start = min(max(start, 0), self._n)
+        stop = min(max(stop, start), self._n)
+        xys = np.asarray(xys, dtype=np.float64).reshape(-1, 2)
+        k = len(xys)
+        n = self._n - (stop - start) + k
+        if n > len(self._buf):
+            self._reserve(n)
+        if k != stop - start:
+            self._buf[start + k:n] = self._buf[stop:self._n]
+        self._buf[start:start + k] = xys
+        self._n = n
+        self._reserve(n)
+
+    def delete(self, start, stop=None):
+        if stop is None:
+            start = self._index(start)
+            stop = start + 1
+        self.splice(start, stop, np.empty((0, 2)))
+
+    def assign(self, xys):
+        self.splice(0, self._n, xys)
+
+    def reverse(self):
+        self._buf[:self._n] = self._buf[self._n - 1::-1] if self._n else self._buf[:0]
+
+
+class PointList:
+    """
+    point storage in python list of QgsPointXY. it is the same interface as PointArray.
+    """
+
+    def __init__(self, xys=None):
+        self._pts = []
+        if xys is not None:
+            self.assign(xys)
+
+    def __len__(self):
+        return len(self._pts)
+
+    def xy(self, idx):
+        return toXY(self._pts[idx])
+
+    def point(self, idx):
+        return self._pts[idx]
+
+    def points(self):
+        return list(self._pts)
+
+    def array(self):
+        return np.array([(p.x(), p.y()) for p in self._pts], dtype=np.float64).reshape(-1, 2)
+
+    def set(self, idx, p):
+        self._pts[idx] = QgsPointXY(p[0], p[1])
+
+    def put(self, indices, xys):
+        for i, p in zip(np.ravel(indices).tolist(), toPointList(xys)):
+            self._pts[i] = p
+
+    def insert(self, idx, p):
+        self._pts.insert(idx, QgsPointXY(p[0], p[1]))
+
+    def splice(self, start, stop, xys):
+        self._pts[start:stop] = toPointList(xys)
+
+    def delete(self, start, stop=None):
+        if stop is None:
+            del self._pts[start]
+        else:
+            del self._pts[start:stop]
+
+    def assign(self, xys):
+        self._pts = toPointList(xys)
+
+    def reverse(self):
+        self._pts.reverse()
+
+
+STORAGES = {"array": PointArray, "list": PointList}
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+""""
+/***************************************************************************
+    BezierEditing
+     --------------------------------------
+    Date                 : 01 05 2019
+    Copyright            : (C) 2019 Takayuki Mizutani
+    Email                : mizutani at ecoris dot co dot jp
+ ***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+benchmark of freehand fitting with and without simplification.
+run it with python of QGIS from any directory:
+    python benchmark/benchmark_fit.py [scale]
+"""
+import importlib
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+plugin_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(plugin_dir))
+fitCurves = importlib.import_module(os.path.basename(plugin_dir) + ".fitCurves")
+
+
+def stroke(n, seed=0):
+    """
+    slow freehand stroke in meter. n nearly coincident points with hand jitter.
+    """
+    rng = np.random.default_rng(seed)
+    t = np.linspace(0, 4 * math.pi, n)
+    line = np.column_stack([t * 40, np.sin(t) * 60 + np.sin(t * 3.7) * 10])
+    return line + rng.normal(scale=0.05, size=(n, 2))
+
+
+def run(points, maxError, ratio, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        simplified = fitCurves.simplifyPoints(points, math.sqrt(maxError) * ratio)
+        beziers = fitCurves.fitCurve(simplified, maxError)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(simplified), len(beziers) + 1, best
+
+
+def main():
+    scale = float(sys.argv[1]) if len(sys.argv) > 1 else 5000.0
+    # same tolerance as BezierGeometry._convertGeometryToBezier in meter
+    maxError = 25 ** (math.log(scale / 2000, 5))
+    print("scale 1:{:.0f}, fitting tolerance {:.3f} m".format(scale, math.sqrt(maxError)))
+    print("{:>8} {:>6} {:>8} {:>8} {:>10}".format("points", "ratio", "fitted", "anchors", "time [ms]"))
+    for n in (1000, 10000, 50000):
+        points = stroke(n)
+        for ratio in (0.0, 0.1, 0.25, 0.5):
+            fitted, anchors, elapsed = run(points, maxError, ratio)
+            print("{:>8} {:>6} {:>8} {:>8} {:>10.1f}".format(n, ratio, fitted, anchors, elapsed * 1000))
+
+
+if __name__ == "__main__":
+    main()
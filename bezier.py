@@ -19,3 +19,31 @@ def qprime(ctrlPoly, t):
 def qprimeprime(ctrlPoly, t):
     return 6 * (1.0 - t) * (ctrlPoly[2] - 2 * ctrlPoly[1] + ctrlPoly[0]) + 6 * (t) * (
                 ctrlPoly[3] - 2 * ctrlPoly[2] + ctrlPoly[1])
+
+
+# evaluates cubic bezier at each t of array, return (n, 2) points
+# float_power gives the same rounding as q() with scalar t
+def qs(ctrlPoly, ts):
+    t = asarray(ts, dtype=float64).reshape(-1, 1)
+    return (float_power(1.0 - t, 3) * ctrlPoly[0] + 3 * float_power(1.0 - t, 2) * t * ctrlPoly[1] +
+            3 * (1.0 - t) * float_power(t, 2) * ctrlPoly[2] + float_power(t, 3) * ctrlPoly[3])
+
+
+_basis = {}
+
+
+# bernstein basis matrix (n + 1, 4) of cubic bezier at t = 0, 1/n, ..., 1
+def basis(n):
+    B = _basis.get(n)
+    if B is None:
+        t = arange(n + 1) / float(n)
+        B = column_stack([(1.0 - t) ** 3, 3 * (1.0 - t) ** 2 * t, 3 * (1.0 - t) * t ** 2, t ** 3])
+        B.setflags(write=False)
+        _basis[n] = B
+    return B
+
+
+# evaluates cubic bezier at n + 1 evenly spaced t, return points
+# ctrlPoly is (4, 2) for a segment or (k, 4, 2) for k segments, return (n + 1, 2) or (k, n + 1, 2)
+def qn(ctrlPoly, n):
+    return matmul(basis(n), asarray(ctrlPoly, dtype=float64))
@@ -2,8 +2,15 @@ SOURCES = \
         bezier.py \
         bezierediting.py \
         beziereditingtool.py \
+        BezierAlgorithms.py \
         BezierGeometry.py \
+        BezierHistory.py \
+        BezierIndex.py \
         BezierMarker.py \
+        BezierProvider.py \
+        BezierStorage.py \
+        fitBatch.py \
+        fitStream.py \
         fitCurves.py \
         __init__.py
 
@@ -25,14 +25,17 @@ import webbrowser
 
 from . import resources
 from .beziereditingtool import BezierEditingTool
+from .BezierProvider import BezierProvider
 
 
 class BezierEditing(object):
 
     def __init__(self, iface):
         self.iface = iface
-        self.canvas = self.iface.mapCanvas()
+        # iface is None when only processing is started by qgis_process
+        self.canvas = self.iface.mapCanvas() if self.iface is not None else None
         self.active = False
+        self.provider = None
 
         # setup translation
         if QSettings().value('locale/overrideFlag', type=bool):
@@ -50,7 +53,13 @@ class BezierEditing(object):
             self.translator.load(locale_path)
             QCoreApplication.installTranslator(self.translator)
 
+    def initProcessing(self):
+        self.provider = BezierProvider()
+        QgsApplication.processingRegistry().addProvider(self.provider)
+
     def initGui(self):
+        self.initProcessing()
+
         # Init the tool
         self.beziertool = BezierEditingTool(self.canvas, self.iface)
 
@@ -258,6 +267,11 @@ Ctrl + right click shows context menu."""
             self.currentTool = None
 
     def unload(self):
+        if self.provider is not None:
+            QgsApplication.processingRegistry().removeProvider(self.provider)
+            self.provider = None
+        if self.iface is None:
+            return
         self.toolbar.removeAction(self.bezier_edit)
         self.toolbar.removeAction(self.freehand)
         self.toolbar.removeAction(self.split)
@@ -267,6 +281,7 @@ Ctrl + right click shows context menu."""
         del self.toolbar
         self.iface.removePluginMenu(self.tr("&Bezier Editing"), self.action)
         self.iface.mapCanvas().mapToolSet.disconnect(self.maptoolChanged)
+        self.beziertool.feature_index.clear()
 
     def log(self, msg):
         QgsMessageLog.logMessage(msg, 'BezierEditing', Qgis.Info)
@@ -16,13 +16,17 @@
  ***************************************************************************/
 """
 from qgis.PyQt.QtCore import Qt
-from qgis.PyQt.QtCore import QObject, QLocale, QTranslator, QCoreApplication, QPointF
+from qgis.PyQt.QtCore import QObject, QLocale, QTranslator, QCoreApplication, QPoint, QPointF, QTimer, QVariant, QByteArray
 from qgis.PyQt.QtGui import QColor, QCursor, QPixmap, QFont, QTextDocument, QIcon
 from qgis.PyQt.QtWidgets import QApplication, QAction, QAbstractButton, QGraphicsItemGroup, QMenu, QInputDialog, QMessageBox, QPushButton
-from qgis.core import QgsSettingsRegistryCore, QgsSettingsEntryBool, QgsWkbTypes, QgsProject, QgsVectorLayer, QgsGeometry, QgsPointXY, QgsFeature, QgsEditFormConfig, QgsFeatureRequest, QgsDistanceArea, QgsRectangle, QgsVectorLayerUtils, Qgis, QgsAction, QgsApplication, QgsMapLayer, QgsCoordinateTransform, QgsExpressionContextScope, QgsSettings, QgsMarkerSymbol, QgsTextAnnotation, QgsMessageLog
+from qgis.core import QgsSettingsRegistryCore, QgsSettingsEntryBool, QgsWkbTypes, QgsProject, QgsVectorLayer, QgsGeometry, QgsPointXY, QgsFeature, QgsEditFormConfig, QgsFeatureRequest, QgsDistanceArea, QgsRectangle, QgsVectorLayerUtils, Qgis, QgsAction, QgsApplication, QgsMapLayer, QgsCoordinateTransform, QgsExpressionContextScope, QgsSettings, QgsMarkerSymbol, QgsTextAnnotation, QgsMessageLog, QgsField, NULL
 from qgis.gui import QgsAttributeEditorContext, QgsMapTool, QgsAttributeDialog, QgsRubberBand, QgsAttributeForm, QgsVertexMarker, QgsHighlight, QgsMapCanvasAnnotationItem
 from .BezierGeometry import *
 from .BezierMarker import *
+from .BezierStorage import STORAGES
+from .BezierHistory import BezierHistory
+from .BezierIndex import FeatureIndex
+import base64
 import math
 import numpy as np
 from typing import Dict, Any, List
@@ -31,6 +35,8 @@ from typing import Dict, Any, List
 class BezierEditingTool(QgsMapTool):
 
     sLastUsedValues: Dict[str, Dict[int, Any]] = dict()
+    # length of text field of the storage whose field length is limited
+    FIELD_LENGTH = {"ESRI Shapefile": 254}
 
     def __init__(self, canvas, iface):
         QgsMapTool.__init__(self, canvas)
@@ -94,6 +100,17 @@ class BezierEditingTool(QgsMapTool):
         self.clicked_idx = None  # clicked anchor or handle idx
         self.bg = None  # BezierGeometry
         self.bm = None  # BezierMarker
+        self.freehand_task = None  # FreehandTask fitting freehand line in background
+        self.freehand_tasks = []  # running FreehandTask including canceled ones, kept until they are finished
+        self.feature_index = FeatureIndex()  # spatial index of features to find near features
+        self.declined_fields = set()  # layer id which bezier fields aren't added to
+        # mouse move is processed once a frame with the latest position
+        self.move_pos = None  # the latest mouse position not processed
+        self.freehand_samples = []  # map points of freehand line not processed
+        self.move_timer = QTimer()
+        self.move_timer.setSingleShot(True)
+        self.move_timer.setInterval(self.frameInterval())
+        self.move_timer.timeout.connect(self.processMove)
 
         # smart guide
         self.guideLabelGroup = None
@@ -106,6 +123,57 @@ class BezierEditingTool(QgsMapTool):
         s = QgsSettings()
         BezierGeometry.INTERPOLATION = int(
             s.value("BezierEditing/INTERPOLATION", 10))
+        # adaptive interpolation. 0 is fixed interpolation count
+        BezierGeometry.INTERPOLATION_TOLERANCE = float(
+            s.value("BezierEditing/INTERPOLATION_TOLERANCE", 0.0))
+        # field saving interpolation count of each segment
+        BezierGeometry.SEGMENTS_FIELD = s.value(
+            "BezierEditing/SEGMENTS_FIELD", BezierGeometry.SEGMENTS_FIELD)
+        # field saving anchors and handles not to invert them from the geometry
+        BezierGeometry.CONTROL_FIELD = s.value(
+            "BezierEditing/CONTROL_FIELD", BezierGeometry.CONTROL_FIELD)
+        save_control = s.value("BezierEditing/SAVE_CONTROL", False)
+        if isinstance(save_control, str):
+            self.save_control = save_control.lower() == "true"
+        else:
+            self.save_control = bool(save_control)
+        # log why the feature isn't bezier line
+        check_log = s.value("BezierEditing/CHECK_LOG", False)
+        if isinstance(check_log, str):
+            BezierGeometry.CHECK_LOG = check_log.lower() == "true"
+        else:
+            BezierGeometry.CHECK_LOG = bool(check_log)
+        # reparameterization count of freehand fitting. 0 is the fastest with more anchors
+        BezierGeometry.FIT_ITERATION = int(
+            s.value("BezierEditing/FIT_ITERATION", BezierGeometry.FIT_ITERATION))
+        # corner angle splitting freehand line. 0 disables
+        BezierGeometry.FIT_CORNER_ANGLE = float(
+            s.value("BezierEditing/FIT_CORNER_ANGLE", BezierGeometry.FIT_CORNER_ANGLE))
+        # simplification of freehand points before fitting. 0 disables
+        BezierGeometry.FIT_SIMPLIFY = float(
+            s.value("BezierEditing/FIT_SIMPLIFY", BezierGeometry.FIT_SIMPLIFY))
+        # freehand line of more points than this is fitted in background task
+        self.fit_task_points = int(s.value("BezierEditing/FIT_TASK_POINTS", 2000))
+        # fit new freehand line while drawing
+        fit_stream = s.value("BezierEditing/FIT_STREAM", BezierGeometry.FIT_STREAM)
+        if isinstance(fit_stream, str):
+            BezierGeometry.FIT_STREAM = fit_stream.lower() == "true"
+        else:
+            BezierGeometry.FIT_STREAM = bool(fit_stream)
+        # max count of undo history
+        BezierHistory.DEPTH = max(1, int(
+            s.value("BezierEditing/HISTORY_DEPTH", BezierHistory.DEPTH)))
+        # max count of features of the layer indexed to find near features
+        FeatureIndex.LIMIT = int(
+            s.value("BezierEditing/FEATURE_INDEX_LIMIT", FeatureIndex.LIMIT))
+        # point storage backend
+        storage = s.value("BezierEditing/STORAGE", "array")
+        if storage in STORAGES:
+            BezierGeometry.STORAGE = storage
+        # working CRS policy
+        working_crs = s.value("BezierEditing/WORKING_CRS", "auto")
+        if working_crs in ("auto", "3857"):
+            BezierGeometry.WORKING_CRS = working_crs
         # Load streaming mode setting
         streaming_val = s.value("BezierEditing/freehand_streaming", False)
         if streaming_val is None:
@@ -126,10 +194,17 @@ class BezierEditingTool(QgsMapTool):
         self.checkCRS()
 
     def canvasPressEvent(self, event):
+        self.processMove()
         modifiers = QApplication.keyboardModifiers()
         layer = self.canvas.currentLayer()
         if not layer or layer.type() != QgsMapLayer.VectorLayer:
             return
+        # the freehand line being fitted is discarded by the next freehand stroke,
+        # and it is added by waiting for the fitting before the other operations such as finishing editing
+        if self.mode == "freehand" and event.button() == Qt.LeftButton:
+            self.cancelFreehandTask()
+        else:
+            self.waitFreehandTask()
         self.checkSnapSetting()
         mouse_point, snapped, snap_point, snap_idx = self.getSnapPoint(event)
         # bezier tool
@@ -172,7 +247,7 @@ class BezierEditingTool(QgsMapTool):
                     elif snapped[3] and not snapped[1]:
                         self.mouse_state = "insert_anchor"
                         self.bg.insert_anchor(snap_idx[3], snap_point[3])
-                        self.bm.show()
+                        self.bm.update()
                     # if click on handle, move handle
                     elif snapped[2]:
                         self.mouse_state = "move_handle"
@@ -270,6 +345,7 @@ class BezierEditingTool(QgsMapTool):
                     self.mouse_state = "drawing_freehand"
                     self.freehand_rbl.reset(QgsWkbTypes.LineGeometry)
                     self.freehand_rbl.addPoint(point)
+                    self.bg.start_stream(self.canvas.scale())
                 # Original drag mode behavior
                 else:
                     # if click on canvas, freehand drawing start
@@ -290,6 +366,7 @@ class BezierEditingTool(QgsMapTool):
                     self.mouse_state = "draw_line"
                     self.freehand_rbl.reset(QgsWkbTypes.LineGeometry)
                     self.freehand_rbl.addPoint(point)
+                    self.bg.start_stream(self.canvas.scale())
         # split tool
         elif self.mode == "split":
             # right click
@@ -308,13 +385,17 @@ class BezierEditingTool(QgsMapTool):
                 if self.editing and self.editing_feature_id is not None:
                     type = layer.geometryType()
                     if type == QgsWkbTypes.LineGeometry:
+                        # bezier line points are changed, so the point is snapped again
+                        self.addBezierFields(layer)
+                        if self.fixInterpolation(layer):
+                            mouse_point, snapped, snap_point, snap_idx = self.getSnapPoint(event)
                         # split on anchor
                         if snapped[1]:
-                            lineA, lineB = self.bg.split_line(
+                            lineA, lineB, countsA, countsB = self.bg.split_line(
                                 snap_idx[1], snap_point[1], isAnchor=True)
                         # split on line
                         elif snapped[3]:
-                            lineA, lineB = self.bg.split_line(
+                            lineA, lineB, countsA, countsB = self.bg.split_line(
                                 snap_idx[3], snap_point[3], isAnchor=False)
                         else:
                             return
@@ -328,10 +409,12 @@ class BezierEditingTool(QgsMapTool):
 
                         feature = self.getFeatureById(
                             layer, self.editing_feature_id)
+                        controlA = self.bg.controlPoints(first=0, last=len(countsA))
+                        controlB = self.bg.controlPoints(first=len(countsA))
                         _, _ = self.createFeature(
-                            geomB, feature, editmode=False, showdlg=False)
+                            geomB, feature, editmode=False, showdlg=False, bezier=controlB)
                         f, _ = self.createFeature(
-                            geomA, feature, editmode=True, showdlg=False)
+                            geomA, feature, editmode=True, showdlg=False, bezier=controlA)
                         layer.removeSelection()
                         layer.select(f.id())
                         self.resetEditing()
@@ -351,6 +434,48 @@ class BezierEditingTool(QgsMapTool):
                 self.showRect(self.startPoint, self.endPoint)
 
     def canvasMoveEvent(self, event):
+        """
+        keep the latest mouse position, and process it at the next frame.
+        all points of freehand line are kept not to lose them.
+        """
+        pos = QPoint(event.pos())
+        if self.isDrawingFreehand():
+            self.freehand_samples.append(self.toMapCoordinates(pos))
+        self.move_pos = pos
+        if not self.move_timer.isActive():
+            self.move_timer.start()
+
+    def frameInterval(self):
+        """
+        return msec of a frame of the screen
+        """
+        screen = QApplication.primaryScreen()
+        rate = screen.refreshRate() if screen is not None else 0
+        if not rate or rate <= 0:
+            rate = 60.0
+        interval = int(1000 / rate)
+        return interval if interval > 1 else 1
+
+    def isDrawingFreehand(self):
+        if self.mode != "freehand":
+            return False
+        if self.freehand_streaming:
+            return self.freehand_drawing and self.mouse_state == "drawing_freehand"
+        return self.mouse_state == "draw_line"
+
+    def processMove(self):
+        """
+        process the latest mouse move. it is called before press and release not to lose the last move.
+        """
+        self.move_timer.stop()
+        pos = self.move_pos
+        if pos is None:
+            return
+        self.move_pos = None
+        self.mouseMoved(pos)
+        self.freehand_samples = []
+
+    def mouseMoved(self, pos):
         modifiers = QApplication.keyboardModifiers()
         if bool(modifiers & Qt.ControlModifier):
             self.smartGuideOn = True
@@ -360,7 +485,7 @@ class BezierEditingTool(QgsMapTool):
         layer = self.canvas.currentLayer()
         if not layer or layer.type() != QgsMapLayer.VectorLayer:
             return
-        mouse_point, snapped, snap_point, snap_idx = self.getSnapPoint(event)
+        mouse_point, snapped, snap_point, snap_idx = self.getSnapPointAt(pos)
         # bezier tool
         if self.mode == "bezier":
             # add anchor and dragging
@@ -439,20 +564,21 @@ class BezierEditingTool(QgsMapTool):
         # freehand tool
         elif self.mode == "freehand":
             self.canvas.setCursor(self.drawline_cursor)
-            # Streaming mode - continuously add points following mouse
-            if self.freehand_streaming and self.freehand_drawing and self.mouse_state == "drawing_freehand":
-                point = mouse_point
-                # on start anchor
-                if snapped[4]:
-                    point = snap_point[4]
-                self.freehand_rbl.addPoint(point)
-            # Original drag mode - add points while dragging
-            elif not self.freehand_streaming and self.mouse_state == "draw_line":
+            # add all points from the last frame. the last point is snapped to the start anchor
+            if self.isDrawingFreehand():
+                samples = self.freehand_samples[:-1]
                 point = mouse_point
                 # on start anchor
                 if snapped[4]:
                     point = snap_point[4]
-                self.freehand_rbl.addPoint(point)
+                committed = False
+                for p in samples + [point]:
+                    self.freehand_rbl.addPoint(p, p is point)
+                    if self.bg is not None and self.bg.add_stream_point(p):
+                        committed = True
+                # committed curves are shown while drawing
+                if committed:
+                    self.bm.update()
         # split tool
         elif self.mode == "split":
             self.canvas.setCursor(self.split_cursor)
@@ -466,6 +592,7 @@ class BezierEditingTool(QgsMapTool):
             self.showRect(self.startPoint, self.endPoint)
 
     def canvasReleaseEvent(self, event):
+        self.processMove()
         modifiers = QApplication.keyboardModifiers()
         layer = self.canvas.currentLayer()
         if not layer or layer.type() != QgsMapLayer.VectorLayer:
@@ -560,6 +687,7 @@ class BezierEditingTool(QgsMapTool):
         """
         convert bezier line to feature and finish editing
         """
+        self.waitFreehandTask()
         layer_type = layer.geometryType()
         layer_wkbtype = layer.wkbType()
         result, geom = self.bg.asGeometry(layer_type, layer_wkbtype)
@@ -576,10 +704,14 @@ class BezierEditingTool(QgsMapTool):
             else:
                 continueFlag = False
         else:
+            self.addBezierFields(layer)
+            if self.fixInterpolation(layer):
+                result, geom = self.bg.asGeometry(layer_type, layer_wkbtype)
+            control = self.bg.controlPoints(layer_type)
             # create new feature
             if self.editing_feature_id is None:
                 f, continueFlag = self.createFeature(
-                    geom, None, editmode=False)
+                    geom, None, editmode=False, bezier=control)
             # modify the feature
             else:
                 feature = self.getFeatureById(layer, self.editing_feature_id)
@@ -595,7 +727,7 @@ class BezierEditingTool(QgsMapTool):
                         continueFlag = False
                 else:
                     f, continueFlag = self.createFeature(
-                        geom, feature, editmode=True)
+                        geom, feature, editmode=True, bezier=control)
         if continueFlag is False:
             self.resetEditing()
         self.canvas.refresh()
@@ -608,14 +740,93 @@ class BezierEditingTool(QgsMapTool):
         scale = self.canvas.scale()
         layer = self.canvas.currentLayer()
         layer_type = layer.geometryType()
-        self.bg.modified_by_geometry(geom, layer_type, scale, snap_to_start)
-        self.bm.show()
+        # new line is fitted while drawing, so only the rest is fitted
+        if self.bg.isStreaming():
+            self.bg.finish_stream(snap_to_start)
+        else:
+            edit = self.bg.start_freehand(geom, layer_type, scale, snap_to_start)
+            if edit is not None and len(edit.points) > self.fit_task_points:
+                self.startFreehandTask(edit)
+                return
+            if edit is not None:
+                self.bg.finish_freehand(edit, edit.fit())
+        self.bm.update()
         self.freehand_rbl.reset()
 
+    def startFreehandTask(self, edit):
+        """
+        fit freehand line in background task. drawing line is shown with busy cursor until it is fitted.
+        """
+        self.freehand_task = FreehandTask(self.tr("Fitting freehand line"), edit, self.freehandTaskFinished)
+        self.freehand_tasks.append(self.freehand_task)
+        QApplication.setOverrideCursor(Qt.BusyCursor)
+        QgsApplication.taskManager().addTask(self.freehand_task)
+
+    def freehandTaskFinished(self, task, result):
+        """
+        add fitted curves to bezier line. if the task is canceled, the freehand line is discarded.
+        """
+        if task in self.freehand_tasks:
+            self.freehand_tasks.remove(task)
+        # already canceled, added by waitFreehandTask or editing is reset
+        if task is not self.freehand_task:
+            return
+        self.freehand_task = None
+        QApplication.restoreOverrideCursor()
+        self.freehand_rbl.reset()
+        if result:
+            self.bg.finish_freehand(task.edit, task.beziers)
+        else:
+            if task.exception is not None:
+                self.log("freehand fitting failed: {}".format(task.exception))
+            if self.bg.cancel_freehand(task.edit) == 0 and not self.bg.history.evicted:
+                self.resetEditing()
+                return
+        self.bm.update(self.show_handle)
+
+    def waitFreehandTask(self):
+        """
+        wait for background task and add the fitted curves, then the bezier line can be converted to feature
+        """
+        task = self.freehand_task
+        if task is None:
+            return
+        self.freehand_task = None
+        QApplication.restoreOverrideCursor()
+        self.freehand_rbl.reset()
+        if task.waitForFinished() and task.beziers is not None:
+            self.bg.finish_freehand(task.edit, task.beziers)
+        else:
+            task.cancel()
+            self.bg.cancel_freehand(task.edit)
+        self.bm.update(self.show_handle)
+
+    def cancelFreehandTask(self):
+        """
+        cancel background task and discard the freehand line. return False if editing is reset.
+        """
+        task = self.freehand_task
+        if task is None:
+            return True
+        self.freehand_task = None
+        task.cancel()
+        QApplication.restoreOverrideCursor()
+        self.freehand_rbl.reset()
+        if self.bg.cancel_freehand(task.edit) == 0 and not self.bg.history.evicted:
+            self.resetEditing()
+            return False
+        self.bm.update(self.show_handle)
+        return True
+
     def resetEditing(self):
         """
         reset bezier setting
         """
+        if self.freehand_task is not None:
+            self.freehand_task.cancel()
+            self.freehand_task = None
+            QApplication.restoreOverrideCursor()
+            self.freehand_rbl.reset()
         self.bm.reset()
         self.bg.reset()
         self.bg = None
@@ -632,7 +843,10 @@ class BezierEditingTool(QgsMapTool):
         """
         geom_type = None
         geom = QgsGeometry(feature.geometry())
+        counts = self.segmentCountsOf(feature)
         self.checkCRS()
+        # saved anchors and handles are used if the geometry isn't changed
+        bg = self.controlPointsOf(feature)
         if self.layerCRS.srsid() != self.projectCRS.srsid():
             geom.transform(QgsCoordinateTransform(
                 self.layerCRS, self.projectCRS, QgsProject.instance()))
@@ -662,10 +876,11 @@ class BezierEditingTool(QgsMapTool):
         elif geom.type() == QgsWkbTypes.LineGeometry:
             geom.convertToSingleType()
             polyline = geom.asPolyline()
-            is_bezier = BezierGeometry.checkIsBezier(self.projectCRS, polyline)
-            if is_bezier:
-                self.bg = BezierGeometry.convertLineToBezier(
-                    self.projectCRS, polyline)
+            if bg is None and BezierGeometry.checkIsBezier(self.projectCRS, polyline, counts):
+                bg = BezierGeometry.convertLineToBezier(
+                    self.projectCRS, polyline, counts=counts)
+            if bg is not None:
+                self.bg = bg
                 self.bm = BezierMarker(self.canvas, self.bg)
                 self.bm.show(self.show_handle)
                 geom_type = geom.type()
@@ -685,11 +900,11 @@ class BezierEditingTool(QgsMapTool):
         elif geom.type() == QgsWkbTypes.PolygonGeometry:
             geom.convertToSingleType()
             polygon = geom.asPolygon()
-            is_bezier = BezierGeometry.checkIsBezier(
-                self.projectCRS, polygon[0])
-            if is_bezier:
-                self.bg = BezierGeometry.convertLineToBezier(
-                    self.projectCRS, polygon[0])
+            if bg is None and BezierGeometry.checkIsBezier(self.projectCRS, polygon[0], counts):
+                bg = BezierGeometry.convertLineToBezier(
+                    self.projectCRS, polygon[0], counts=counts)
+            if bg is not None:
+                self.bg = bg
                 self.bm = BezierMarker(self.canvas, self.bg)
                 self.bm.show(self.show_handle)
                 geom_type = geom.type()
@@ -712,9 +927,11 @@ class BezierEditingTool(QgsMapTool):
 
         return geom_type
 
-    def createFeature(self, geom, feature, editmode=True, showdlg=True):
+    def createFeature(self, geom, feature, editmode=True, showdlg=True, bezier=None):
         """
         create or edit feature
+        bezier is anchors, handles and interpolation counts from BezierGeometry.controlPoints.
+        they are saved to the segments field and the control field if the layer has them.
         Referred to
         https://github.com/EnMAP-Box/qgispluginsupport/blob/master/qps/maptools.py#L717
         """
@@ -747,6 +964,21 @@ class BezierEditingTool(QgsMapTool):
             elif (reuseLastValues or lyr.editFormConfig().reuseLastValue(idx)) and layer.id() in self.sLastUsedValues.keys() and idx in self.sLastUsedValues[lyr.id()].keys():
                 lastUsed = self.sLastUsedValues[lyr.id()][idx]
                 initialAttributeValues[idx] = lastUsed
+        bezier_values = dict()
+        if bezier is not None:
+            segments_idx = fields.indexOf(BezierGeometry.SEGMENTS_FIELD)
+            if segments_idx != -1:
+                bezier_values[segments_idx] = BezierGeometry.encodeSegmentCounts(
+                    bezier[2], BezierGeometry.geometryHash(geom))
+            control_idx = fields.indexOf(BezierGeometry.CONTROL_FIELD)
+            if control_idx != -1:
+                blob = self.bg.packControlPoints(bezier, BezierGeometry.geometryHash(geom))
+                if fields.at(control_idx).type() == QVariant.ByteArray:
+                    bezier_values[control_idx] = QByteArray(blob)
+                else:
+                    bezier_values[control_idx] = base64.b64encode(blob).decode("ascii")
+            self.checkFieldLength(fields, bezier_values)
+        initialAttributeValues.update(bezier_values)
 
         context = layer.createExpressionContext()
         f = QgsVectorLayerUtils.createFeature(
@@ -795,6 +1027,8 @@ class BezierEditingTool(QgsMapTool):
                 ok = dlg.exec_()
                 if ok:
                     layer.changeGeometry(feature.id(), geom)
+                    for idx, value in bezier_values.items():
+                        layer.changeAttributeValue(feature.id(), idx, value)
                     layer.endEditCommand()
                 else:
                     layer.destroyEditCommand()
@@ -829,14 +1063,85 @@ class BezierEditingTool(QgsMapTool):
                 origValues[idx] = newValues[idx]
         self.sLastUsedValues[lyr.id()] = origValues
 
+    def segmentCountsOf(self, feature):
+        """
+        return interpolation count of each segment saved in the feature, or None if it isn't saved.
+        """
+        return BezierGeometry.featureSegmentCounts(feature)
+
+    def controlPointsOf(self, feature):
+        """
+        return bezier line made from anchors and handles saved in the feature,
+        or None if they aren't saved or the geometry is changed after saved.
+        """
+        return BezierGeometry.convertFeatureControlToBezier(self.projectCRS, feature)
+
+    def addBezierFields(self, layer):
+        """
+        add the field saving interpolation count of each segment if adaptive interpolation is used,
+        and the field saving anchors and handles if it is set. the user is asked before adding them.
+        without the fields, features are converted to bezier by fixed interpolation count.
+        """
+        names = []
+        if BezierGeometry.INTERPOLATION_TOLERANCE > 0:
+            names.append(BezierGeometry.SEGMENTS_FIELD)
+        if self.save_control:
+            names.append(BezierGeometry.CONTROL_FIELD)
+        names = [name for name in names if layer.fields().indexOf(name) == -1]
+        if len(names) == 0 or layer.id() in self.declined_fields:
+            return
+        reply = QMessageBox.question(None, self.tr("Add fields"), self.tr(
+            "Do you want to add \"{}\" field to the layer to save bezier line?").format("\", \"".join(names)),
+            QMessageBox.Yes | QMessageBox.No, QMessageBox.Yes)
+        if reply != QMessageBox.Yes:
+            self.declined_fields.add(layer.id())
+            return
+        # the length of text field is set explicitly if it is limited, so it is checked before saving
+        length = self.FIELD_LENGTH.get(layer.dataProvider().storageType(), 0)
+        for name in names:
+            layer.addAttribute(QgsField(name, QVariant.String, "", length))
+
+    def fixInterpolation(self, layer):
+        """
+        interpolate bezier line by fixed count if the layer doesn't have the field saving interpolation counts.
+        return True if bezier line is changed.
+        """
+        if layer.fields().indexOf(BezierGeometry.SEGMENTS_FIELD) != -1:
+            return False
+        if not self.bg.useFixedInterpolation():
+            return False
+        self.bm.update(self.show_handle)
+        return True
+
+    def checkFieldLength(self, fields, values):
+        """
+        replace text values longer than the field length with NULL, because truncated values can't be read.
+        values is dict of field idx to value. it is returned.
+        """
+        names = []
+        for idx, value in values.items():
+            if isinstance(value, str) and not BezierGeometry.fitsField(fields.at(idx), value):
+                values[idx] = NULL
+                names.append(fields.at(idx).name())
+        if names:
+            self.iface.messageBar().pushMessage(
+                self.tr("Warning"), self.tr("\"{}\" isn't saved because the field is too short").format(
+                    "\", \"".join(names)), level=Qgis.Warning)
+        return values
+
     def undo(self):
         """
         undo bezier editing (add, move, delete , draw) for anchor and handle
         """
+        # the freehand line being fitted is undone by canceling it
+        if self.freehand_task is not None:
+            self.cancelFreehandTask()
+            return
         if self.bg is not None:
             history_length = self.bg.undo()
-            self.bm.show(self.show_handle)
-            if history_length == 0:
+            self.bm.update(self.show_handle)
+            # empty history after eviction isn't the original state
+            if history_length == 0 and not self.bg.history.evicted:
                 self.resetEditing()
 
     def showHandle(self, checked):
@@ -882,6 +1187,12 @@ class BezierEditingTool(QgsMapTool):
         return mouse point and snapped point list.
         snapped point list is 0:map, 1:anchor, 2:handle, 3:bezier line, 4:start anchor
         """
+        return self.getSnapPointAt(event.pos())
+
+    def getSnapPointAt(self, pos):
+        """
+        getSnapPoint at mouse position pos
+        """
         snap_idx = ["", "", "", "", "", ""]
         snapped = [False, False, False, False, False, False]
         snap_point = [None, None, None, None, None, None]
@@ -894,22 +1205,16 @@ class BezierEditingTool(QgsMapTool):
         self.guideLabelGroup = QGraphicsItemGroup()
         self.canvas.scene().addItem(self.guideLabelGroup)
 
-        mouse_point = self.toMapCoordinates(event.pos())
-        snapped[0], snap_point[0] = self.checkSnapToPoint(event.pos())
+        mouse_point = self.toMapCoordinates(pos)
+        snapped[0], snap_point[0] = self.checkSnapToPoint(pos)
 
         if self.bg is not None:
             point = snap_point[0]
             snap_distance = self.canvas.scale() / 500
             #d = self.canvas.mapUnitsPerPixel() * 4
-            snapped[1], snap_point[1], snap_idx[1] = self.bg.checkSnapToAnchor(
-                point, self.clicked_idx, snap_distance)
-            if self.show_handle and self.mode == "bezier":
-                snapped[2], snap_point[2], snap_idx[2] = self.bg.checkSnapToHandle(
-                    point, snap_distance)
-            snapped[3], snap_point[3], snap_idx[3] = self.bg.checkSnapToLine(
-                point, snap_distance)
-            snapped[4], snap_point[4], snap_idx[4] = self.bg.checkSnapToStart(
-                point, snap_distance)
+            # anchor, handle, bezier line and start anchor
+            snapped[1:5], snap_point[1:5], snap_idx[1:5] = self.bg.checkSnap(
+                point, self.clicked_idx, snap_distance, self.show_handle and self.mode == "bezier")
 
             if self.smartGuideOn and self.mode == "bezier" and self.bg.anchorCount() > 0 and not snapped[1]:
                 # calc the angle from line made by point0 and point1
@@ -976,6 +1281,18 @@ class BezierEditingTool(QgsMapTool):
             BezierGeometry.INTERPOLATION = num
             s = QgsSettings()
             s.setValue("BezierEditing/INTERPOLATION",  num)
+        tolerance, ok = QInputDialog.getDouble(QInputDialog(), self.tr("Tolerance"), self.tr(
+            "Enter adaptive interpolation tolerance in meters (0 is fixed count)"), BezierGeometry.INTERPOLATION_TOLERANCE, 0, 10000, 3)
+        if ok:
+            BezierGeometry.INTERPOLATION_TOLERANCE = tolerance
+            s = QgsSettings()
+            s.setValue("BezierEditing/INTERPOLATION_TOLERANCE", tolerance)
+        reply = QMessageBox.question(None, self.tr("Save anchors and handles"), self.tr(
+            "Do you want to save anchors and handles to \"{}\" field?\nThe field is added to the layer if it doesn't exist.").format(BezierGeometry.CONTROL_FIELD),
+            QMessageBox.Yes | QMessageBox.No, QMessageBox.Yes if self.save_control else QMessageBox.No)
+        self.save_control = reply == QMessageBox.Yes
+        s = QgsSettings()
+        s.setValue("BezierEditing/SAVE_CONTROL", self.save_control)
 
     def lengthSnapPoint(self, origin_point, point):
         v = point - origin_point
@@ -1124,13 +1441,34 @@ class BezierEditingTool(QgsMapTool):
 
     def getFeatureById(self, layer, featid):
         features = [f for f in layer.getFeatures(
-            QgsFeatureRequest().setFilterFids([featid]))]
+            QgsFeatureRequest().setFilterFid(featid))]
         if len(features) != 1:
             return None
         else:
             return features[0]
 
     def getNearFeatures(self, layer, point, rect=None):
+        """
+        return features near the point or in rect, with geometry and the fields saving bezier
+        """
+        fids = self.getNearFeatureIds(layer, point, rect)
+        if len(fids) == 0:
+            return False, None
+        names = [BezierGeometry.SEGMENTS_FIELD, BezierGeometry.CONTROL_FIELD]
+        request = QgsFeatureRequest().setFilterFids(fids)
+        request.setSubsetOfAttributes([name for name in names if layer.fields().indexOf(name) != -1],
+                                      layer.fields())
+        f = [feat for feat in layer.getFeatures(request)]
+        if len(f) == 0:
+            return False, None
+        else:
+            return True, f
+
+    def getNearFeatureIds(self, layer, point, rect=None, build=True):
+        """
+        return ids of features near the point or in rect by the spatial index.
+        if build is False, the index of the layer isn't built and the features are requested by rectangle.
+        """
         if rect is None:
             dist = self.canvas.mapUnitsPerPixel() * 4
             rect = QgsRectangle(
@@ -1141,13 +1479,7 @@ class BezierEditingTool(QgsMapTool):
             rectGeom.transform(QgsCoordinateTransform(
                 self.projectCRS, self.layerCRS, QgsProject.instance()))
             rect = rectGeom.boundingBox()
-        request = QgsFeatureRequest()
-        request.setFilterRect(rect)
-        f = [feat for feat in layer.getFeatures(request)]
-        if len(f) == 0:
-            return False, None
-        else:
-            return True, f
+        return self.feature_index.ids(layer, rect, build)
 
     def checkSnapSetting(self):
         snap_cfg = self.iface.mapCanvas().snappingUtils().config()
@@ -1201,9 +1533,10 @@ class BezierEditingTool(QgsMapTool):
     def selectNearFeature(self, layer, point, rect=None):
         if rect is not None:
             layer.removeSelection()
-        near, features = self.getNearFeatures(layer, point, rect)
+        # it is called for all layers, so the index is used only if it is already built by editing
+        fids = self.getNearFeatureIds(layer, point, rect, build=False)
+        near = len(fids) > 0
         if near:
-            fids = [f.id() for f in features]
             if rect is not None:
                 layer.selectByIds(fids)
             else:
@@ -1247,6 +1580,8 @@ class BezierEditingTool(QgsMapTool):
                 geom1.convertToSingleType()
                 line0 = geom0.asPolyline()
                 line1 = geom1.asPolyline()
+                counts0 = BezierGeometry.lineSegmentCounts(line0, self.segmentCountsOf(f0))
+                counts1 = BezierGeometry.lineSegmentCounts(line1, self.segmentCountsOf(f1))
 
                 # Connect points with the smallest distance from all combinations of endpoints
                 dist = [self.distance(li0, li1) for li0, li1 in
@@ -1257,13 +1592,18 @@ class BezierEditingTool(QgsMapTool):
                 elif type == 1:
                     line0.reverse()
                     line1.reverse()
+                    counts0 = counts0 and counts0[::-1]
+                    counts1 = counts1 and counts1[::-1]
                 elif type == 2:
                     line0.reverse()
+                    counts0 = counts0 and counts0[::-1]
                 elif type == 3:
                     line1.reverse()
+                    counts1 = counts1 and counts1[::-1]
                 # if endpoints are same position
                 if line0[-1] == line1[0]:
                     line = line0 + line1[1:]
+                    counts_between = []
                 # If the end points are separated, the are interpolated using Bezier line
                 else:
                     b = BezierGeometry(self.projectCRS)
@@ -1271,12 +1611,24 @@ class BezierEditingTool(QgsMapTool):
                     b.add_anchor(1, line1[0], undo=False)
                     interporate_line = b.asPolyline()
                     line = line0 + interporate_line[1:] + line1[1:]
-
+                    counts_between = b.segmentCounts()
                 if layer.wkbType() == QgsWkbTypes.LineString:
                     geom = QgsGeometry.fromPolylineXY(line)
                 elif layer.wkbType() == QgsWkbTypes.MultiLineString:
                     geom = QgsGeometry.fromMultiPolylineXY([line])
 
+                # interpolation counts are unknown if either feature isn't bezier line
+                if counts0 is not None and counts1 is not None:
+                    segments = BezierGeometry.encodeSegmentCounts(
+                        counts0 + counts_between + counts1, BezierGeometry.geometryHash(geom))
+                else:
+                    segments = NULL
+                segments_idx = fields.indexOf(BezierGeometry.SEGMENTS_FIELD)
+                if segments_idx != -1:
+                    segments = self.checkFieldLength(fields, {segments_idx: segments})[segments_idx]
+                # saved anchors and handles are cleared. the merged feature is converted from the geometry
+                control_idx = fields.indexOf(BezierGeometry.CONTROL_FIELD)
+
                 layer.beginEditCommand(self.tr("Bezier unsplit"))
                 settings = QgsSettings()
                 disable_val = settings.value("/qgis/digitizing/disable_enter_attribute_values_dialog", False)
@@ -1288,12 +1640,20 @@ class BezierEditingTool(QgsMapTool):
                     disable_attributes = bool(disable_val)
                 if disable_attributes or fields.count() == 0:
                     layer.changeGeometry(f0.id(), geom)
+                    if segments_idx != -1:
+                        layer.changeAttributeValue(f0.id(), segments_idx, segments)
+                    if control_idx != -1:
+                        layer.changeAttributeValue(f0.id(), control_idx, NULL)
                     layer.deleteFeature(f1.id())
                     layer.endEditCommand()
                 else:
                     dlg = self.iface.getFeatureForm(layer, f0)
                     if dlg.exec_():
                         layer.changeGeometry(f0.id(), geom)
+                        if segments_idx != -1:
+                            layer.changeAttributeValue(f0.id(), segments_idx, segments)
+                        if control_idx != -1:
+                            layer.changeAttributeValue(f0.id(), control_idx, NULL)
                         layer.deleteFeature(f1.id())
                         layer.endEditCommand()
                     else:
@@ -1314,6 +1674,9 @@ class BezierEditingTool(QgsMapTool):
         self.resetUnsplit()
 
     def deactivate(self):
+        self.move_timer.stop()
+        self.move_pos = None
+        self.freehand_samples = []
         # self.canvas.unsetMapTool(self)
         # QgsMapTool.deactivate(self)
         # self.log("deactivate")
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+""""
+/***************************************************************************
+    BezierEditing
+     --------------------------------------
+    Date                 : 01 05 2019
+    Copyright            : (C) 2019 Takayuki Mizutani
+    Email                : mizutani at ecoris dot co dot jp
+ ***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+batch curve fitting of many lines in a process pool.
+only numpy arrays are passed to worker processes, so this module must not import qgis.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import multiprocessing.spawn
+import os
+
+import numpy as np
+
+from .fitCurves import fitCurve, simplifyPoints
+
+CHUNK_POINTS = 50000  # approximate count of points sent to a worker at once
+
+
+def fitLines(lines, maxError, maxIterations=4, cornerAngle=0.0, simplify=0.0, workers=None,
+             progress=None, isCanceled=None):
+    """
+    fit bezier curves to each line of (N, 2) coordinates.
+    return list of (k, 4, 2) arrays in order of lines, or None if canceled.
+    results don't depend on workers. workers=1 fits in this process.
+    progress(done, total) is called after each chunk of lines. isCanceled() stops fitting.
+    """
+    lines = [np.asarray(line, dtype=np.float64).reshape(-1, 2) for line in lines]
+    options = (maxError, maxIterations, cornerAngle, simplify)
+    chunks = _chunks(lines)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(chunks))
+    if workers > 1:
+        context = _context()
+        if context is not None:
+            try:
+                with ProcessPoolExecutor(workers, mp_context=context) as executor:
+                    futures = [executor.submit(_fitChunk, [lines[i] for i in chunk], options) for chunk in chunks]
+                    beziers = _collect(futures, len(lines), progress, isCanceled, lambda future: future.result())
+                    if beziers is None:
+                        for future in futures:
+                            future.cancel()
+                    return beziers
+            except (BrokenProcessPool, OSError):
+                # process can't be started in this environment
+                pass
+    return _collect([[lines[i] for i in chunk] for chunk in chunks], len(lines), progress, isCanceled,
+                    lambda part: _fitChunk(part, options))
+
+
+def controlPointsOf(beziers):
+    """
+    return anchors (k + 1, 2) and handles (2k + 2, 2) of fitted (k, 4, 2) curves.
+    handles of both ends are on the anchor.
+    """
+    anchors = np.concatenate((beziers[:, 0], beziers[-1:, 3]))
+    handles = np.repeat(anchors, 2, axis=0)
+    handles[1:-1:2] = beziers[:, 1]
+    handles[2::2] = beziers[:, 2]
+    return anchors, handles
+
+
+def fitLine(line, maxError, maxIterations=4, cornerAngle=0.0, simplify=0.0, isCanceled=None):
+    """
+    fit bezier curves to a line of (N, 2) coordinates and return (k, 4, 2) array.
+    isCanceled() stops fitting and None is returned.
+    """
+    if len(line) < 2:
+        return np.empty((0, 4, 2))
+    if simplify > 0:
+        line = simplifyPoints(line, np.sqrt(maxError) * simplify)
+    return fitCurve(line, maxError, maxIterations, cornerAngle, isCanceled=isCanceled)
+
+
+def _fitChunk(lines, options):
+    return [fitLine(line, *options) for line in lines]
+
+
+def _chunks(lines):
+    # consecutive lines up to CHUNK_POINTS points. the chunks don't depend on workers
+    chunks = []
+    chunk = []
+    size = 0
+    for i, line in enumerate(lines):
+        if chunk and size + len(line) > CHUNK_POINTS:
+            chunks.append(chunk)
+            chunk = []
+            size = 0
+        chunk.append(i)
+        size += len(line)
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def _collect(jobs, total, progress, isCanceled, result):
+    # results in order of chunks
+    beziers = []
+    for job in jobs:
+        if isCanceled is not None and isCanceled():
+            return None
+        beziers.extend(result(job))
+        if progress is not None:
+            progress(len(beziers), total)
+    return beziers
+
+
+def _context():
+    """
+    spawn context, so QGIS is not forked and not started as a worker.
+    return None if the executable of spawn isn't python, e.g. it is QGIS itself.
+    the executable isn't set here, because it is global for all spawn contexts of the interpreter.
+    """
+    executable = os.fsdecode(multiprocessing.spawn.get_executable())
+    if not os.path.basename(executable).lower().startswith("python"):
+        return None
+    return multiprocessing.get_context("spawn")
@@ -7,74 +7,162 @@
 from __future__ import print_function
 from numpy import *
 from . import bezier
-from qgis.core import *
+
+# reparameterization is stopped when parameters move less than this
+CONVERGENCE = 1.0e-6
+# window of corner detection, ratio to fitting distance
+CORNER_WINDOW = 2.0
+
 
 # Fit one (ore more) Bezier curves to a set of points
-def fitCurve(points, maxError):
-    leftTangent = normalize(points[1] - points[0])
-    rightTangent = normalize(points[-2] - points[-1])
-    return fitCubic(points, leftTangent, rightTangent, maxError)
+# maxIterations is max count of reparameterization before splitting. 0 disables it.
+# points are split at corners sharper than cornerAngle in degree, and each run is fit independently.
+# 0 disables corner detection.
+# leftTangent fixes the tangent of the first point, e.g. to continue a curve fitted before.
+# isCanceled() stops fitting and None is returned.
+def fitCurve(points, maxError, maxIterations=4, cornerAngle=0.0, leftTangent=None, isCanceled=None):
+    if cornerAngle <= 0:
+        return fitRun(points, maxError, maxIterations, leftTangent=leftTangent, isCanceled=isCanceled)
+    window = sqrt(maxError) * CORNER_WINDOW
+    corners = findCorners(points, cornerAngle, window)
+    bounds = concatenate(([0], corners, [len(points) - 1]))
+    runs = []
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        run = fitRun(points[first:last + 1], maxError, maxIterations, window,
+                     leftTangent if first == 0 else None, isCanceled)
+        if run is None:
+            return None
+        runs.append(run)
+    return concatenate(runs)
+
+
+def fitRun(points, maxError, maxIterations=4, window=0.0, leftTangent=None, isCanceled=None):
+    # Fit a G1 continuous run of points
+    # tangents of ends are directions to the points at window distance. 0 uses the next points.
+    if window > 0:
+        if leftTangent is None:
+            leftTangent = endTangent(points, window)
+        rightTangent = endTangent(points[::-1], window)
+    else:
+        if leftTangent is None:
+            leftTangent = normalize(points[1] - points[0])
+        rightTangent = normalize(points[-2] - points[-1])
+    return fitCubic(points, leftTangent, rightTangent, maxError, maxIterations, isCanceled)
+
+
+def endTangent(points, window):
+    # direction from the first point to the first point at window distance, or to the last point
+    d = points - points[0]
+    far = nonzero(rowDot(d, d) >= window ** 2)[0]
+    return normalize(points[far[0] if len(far) else -1] - points[0])
 
 
-def fitCubic(points, leftTangent, rightTangent, error):
+def findCorners(points, angle, window):
+    """
+    return indices of corners in points, in order.
+    turning angle at each point is measured between the points at window distance along the line before and after it.
+    the sharpest point in window is the corner.
+    """
+    n = len(points)
+    if n < 3:
+        return zeros(0, dtype=int)
+    d = diff(points, axis=0)
+    s = concatenate(([0.0], cumsum(sqrt(rowDot(d, d)))))  # distance along the line
+    idx = arange(n)
+    back = clip(searchsorted(s, s - window, side="right") - 1, 0, n - 1)
+    forward = clip(searchsorted(s, s + window, side="left"), 0, n - 1)
+    valid = (back < idx) & (idx < forward)
+    vin = points - points[back]
+    vout = points[forward] - points
+    length = sqrt(rowDot(vin, vin) * rowDot(vout, vout))
+    valid &= length > 0
+    cos_turn = rowDot(vin, vout) / where(valid, length, 1.0)
+    turn = degrees(arccos(clip(cos_turn, -1.0, 1.0)))
+    candidates = nonzero(valid & (turn > angle))[0]
+
+    # keep the sharpest one in window
+    corners = []
+    for i in candidates[argsort(-turn[candidates], kind="stable")]:
+        if all(absolute(s[corners] - s[i]) >= window):
+            corners.append(i)
+    return sort(array(corners, dtype=int))
+
+
+def fitCubic(points, leftTangent, rightTangent, error, maxIterations=4, isCanceled=None):
+    # Fit ranges of points from the first one. ranges are views of points.
+    # the right range is pushed before the left range, so segments are in order of points.
+    # return None if isCanceled() is True
+    beziers = empty((len(points) - 1, 4, 2))  # a segment has two points at least
+    count = 0
+    ranges = [(0, len(points) - 1, leftTangent, rightTangent)]
+    while ranges:
+        if isCanceled is not None and isCanceled():
+            return None
+        first, last, left, right = ranges.pop()
+        bezCurve, splitPoint = fitSingle(points[first:last + 1], left, right, error, maxIterations)
+        if bezCurve is not None:
+            beziers[count] = bezCurve
+            count += 1
+            continue
+
+        # Fitting failed -- split at max error point and fit each range
+        splitPoint += first
+        centerTangent = normalize(points[splitPoint-1] - points[splitPoint+1])
+        ranges.append((splitPoint, last, -centerTangent, right))
+        ranges.append((first, splitPoint, left, centerTangent))
+
+    return beziers[:count]
+
+
+def fitSingle(points, leftTangent, rightTangent, error, maxIterations=4):
+    # Fit one Bezier curve to points, return (curve, None) or (None, split point) if error is too large
     # Use heuristic if region only has two points in it
     if (len(points) == 2):
         dist = linalg.norm(points[0] - points[1]) / 3.0
         bezCurve = [points[0], points[0] + leftTangent * dist, points[1] + rightTangent * dist, points[1]]
-        return [bezCurve]
+        return bezCurve, None
 
     # Parameterize points, and attempt to fit curve
     u = chordLengthParameterize(points)
-    #return leftTangent
     bezCurve = generateBezier(points, u, leftTangent, rightTangent)
     # Find max deviation of points to fitted curve
     maxError, splitPoint = computeMaxError(points, bezCurve, u)
     if maxError < error:
-        return [bezCurve]
+        return bezCurve, None
 
-    # # If error not too large, try some reparameterization and iteration
-    # if maxError < error**2:
-    #     for i in range(200):
-    #         uPrime = reparameterize(bezCurve, points, u)
-    #         bezCurve = generateBezier(points, uPrime, leftTangent, rightTangent)
-    #         maxError, splitPoint = computeMaxError(points, bezCurve, uPrime)
-    #         if maxError < error:
-    #             mylog("C{}".format(i))
-    #             return [bezCurve]
-    #         u = uPrime
+    # If error not too large, try some reparameterization and iteration.
+    # error is squared distance, so this is twice the distance.
+    if maxError < error * 4.0:
+        for i in range(maxIterations):
+            uPrime = reparameterize(bezCurve, points, u)
+            bezCurve = generateBezier(points, uPrime, leftTangent, rightTangent)
+            maxError, splitPoint = computeMaxError(points, bezCurve, uPrime)
+            if maxError < error:
+                return bezCurve, None
+            if abs(uPrime - u).max() < CONVERGENCE:
+                break
+            u = uPrime
 
-    # # Fitting failed -- split at max error point and fit recursively
-    beziers = []
-    centerTangent = normalize(points[splitPoint-1] - points[splitPoint+1])
-    beziers += fitCubic(points[:splitPoint+1], leftTangent, centerTangent, error)
-    beziers += fitCubic(points[splitPoint:], -centerTangent, rightTangent, error)
-
-    return beziers
+    return None, splitPoint
 
 
 def generateBezier(points, parameters, leftTangent, rightTangent):
     bezCurve = [points[0], None, None, points[-1]]
+    # (n, 1) column of parameters. float_power is used for the same rounding as the scalar power
+    u = asarray(parameters, dtype=float64).reshape(-1, 1)
+    w = 1 - u
 
-    # compute the A's
-    A = zeros((len(parameters), 2, 2))
-    for i, u in enumerate(parameters):
-        A[i][0] = leftTangent  * 3*(1-u)**2 * u
-        A[i][1] = rightTangent * 3*(1-u)    * u**2
+    # compute the A's, (n, 2) for each tangent
+    A0 = leftTangent  * 3*float_power(w, 2) * u
+    A1 = rightTangent * 3*w                 * float_power(u, 2)
 
     # Create the C and X matrices
-    C = zeros((2, 2))
-    X = zeros(2)
-
-    for i, (point, u) in enumerate(zip(points, parameters)):
-        C[0][0] += dot(A[i][0], A[i][0])
-        C[0][1] += dot(A[i][0], A[i][1])
-        C[1][0] += dot(A[i][0], A[i][1])
-        C[1][1] += dot(A[i][1], A[i][1])
-
-        tmp = point - bezier.q([points[0], points[0], points[-1], points[-1]], u)
-
-        X[0] += dot(A[i][0], tmp)
-        X[1] += dot(A[i][1], tmp)
+    tmp = points - bezier.qs([points[0], points[0], points[-1], points[-1]], u)
+    # rows are summed in order of points, as the loop did
+    terms = column_stack([rowDot(A0, A0), rowDot(A0, A1), rowDot(A1, A1), rowDot(A0, tmp), rowDot(A1, tmp)])
+    c00, c01, c11, x0, x1 = add.reduce(terms, axis=0)
+    C = array([[c00, c01], [c01, c11]])
+    X = array([x0, x1])
 
     # Compute the determinants of C and X
     det_C0_C1 = C[0][0] * C[1][1] - C[1][0] * C[0][1]
@@ -107,10 +195,10 @@ def generateBezier(points, parameters, leftTangent, rightTangent):
 
 
 def reparameterize(bezier, points, parameters):
-    return [newtonRaphsonRootFind(bezier, point, u) for point, u in zip(points, parameters)]
+    return newtonRaphsonRootFind(bezier, points, asarray(parameters, dtype=float64))
 
 
-def newtonRaphsonRootFind(bez, point, u):
+def newtonRaphsonRootFind(bez, points, u):
     """
        Newton's root finding algorithm calculates f(x)=0 by reiterating
        x_n+1 = x_n - f(x_n)/f'(x_n)
@@ -125,44 +213,85 @@ def newtonRaphsonRootFind(bez, point, u):
 
        gives
        u_n+1 = u_n - |q(u_n)-p * q'(u_n)| / |q'(u_n)**2 + q(u_n)-p * q''(u_n)|
+
+       one step for all points at once. u is array of parameters of points.
     """
-    d = bezier.q(bez, u)-point
-    numerator = (d * bezier.qprime(bez, u)).sum()
-    denominator = (bezier.qprime(bez, u)**2 + d * bezier.qprimeprime(bez, u)).sum()
+    t = u.reshape(-1, 1)
+    d = bezier.qs(bez, u) - points
+    qprime = bezier.qprime(bez, t)
+    numerator = (d * qprime).sum(axis=1)
+    denominator = (qprime**2 + d * bezier.qprimeprime(bez, t)).sum(axis=1)
 
-    if denominator == 0.0:
-        return u
-    else:
-        return u - numerator/denominator
+    zero = denominator == 0.0
+    return where(zero, u, u - numerator / where(zero, 1.0, denominator))
 
 
 def chordLengthParameterize(points):
-    u = [0.0]
-    for i in range(1, len(points)):
-        u.append(u[i-1] + linalg.norm(points[i] - points[i-1]))
-
-    for i, _ in enumerate(u):
-        u[i] = u[i] / u[-1]
-
-    return u
+    # cumulative chord length normalized to 0..1
+    d = diff(points, axis=0)
+    u = concatenate(([0.0], cumsum(sqrt(rowDot(d, d)))))
+    return u / u[-1]
 
 
 def computeMaxError(points, bez, parameters):
-    maxDist = 0.0
-    splitPoint = len(points)/2
-    for i, (point, u) in enumerate(zip(points, parameters)):
-        dist = linalg.norm(bezier.q(bez, u)-point)**2
-        if dist > maxDist:
-            maxDist = dist
-            splitPoint = i
-
-    return maxDist, splitPoint
+    # squared distance of each point to the curve
+    d = bezier.qs(bez, parameters) - points
+    dist = float_power(sqrt(rowDot(d, d)), 2)
+    splitPoint = int(argmax(dist))
+    if not dist[splitPoint] > 0.0:
+        return 0.0, len(points) // 2
+    return dist[splitPoint], splitPoint
+
+
+def simplifyPoints(points, tolerance):
+    # Douglas-Peucker simplification. points farther than tolerance from the simplified line are kept.
+    # the first and the last points are always kept.
+    if len(points) < 3 or tolerance <= 0:
+        return points
+    keep = zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    ranges = [(0, len(points) - 1)]
+    while ranges:
+        first, last = ranges.pop()
+        if last - first < 2:
+            continue
+        d = points[first + 1:last] - points[first]
+        chord = points[last] - points[first]
+        length = linalg.norm(chord)
+        if length == 0.0:
+            dist = sqrt(rowDot(d, d))
+        else:
+            dist = absolute(d[:, 0] * chord[1] - d[:, 1] * chord[0]) / length
+        i = int(argmax(dist))
+        if dist[i] > tolerance:
+            i += first + 1
+            keep[i] = True
+            ranges.append((i, last))
+            ranges.append((first, i))
+    return points[keep]
+
+
+def smoothPoints(points, offset=0.25):
+    # Chaikin's corner cutting with one iteration as QgsGeometry.smooth() of an open line.
+    # each segment is cut at offset from both ends, and the first and the last points are kept.
+    if len(points) < 3:
+        return points
+    start = points[:-1]
+    d = points[1:] - start
+    smooth = empty((2 * len(start), 2))
+    smooth[0::2] = start + d * offset
+    smooth[1::2] = start + d * (1.0 - offset)
+    smooth[0] = points[0]
+    smooth[-1] = points[-1]
+    return smooth
+
+
+def rowDot(a, b):
+    # dot product of each row of (n, 2) arrays. matmul gives the same result as dot() of each row
+    return matmul(a[:, newaxis, :], b[:, :, newaxis])[:, 0, 0]
 
 
 def normalize(v):
     if allclose(v, array([0, 0])):
         v = array([0.00001, 0.00001])
     return v / linalg.norm(v)
-
-def mylog(msg):
-    QgsMessageLog.logMessage(msg, 'MyPlugin', Qgis.Info)
\ No newline at end of file
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+""""
+/***************************************************************************
+    BezierEditing
+     --------------------------------------
+    Date                 : 01 05 2019
+    Copyright            : (C) 2019 Takayuki Mizutani
+    Email                : mizutani at ecoris dot co dot jp
+ ***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+incremental curve fitting of freehand points while drawing.
+"""
+import numpy as np
+
+from .fitCurves import fitCurve, simplifyPoints, normalize
+
+
+class StreamFitter:
+    """
+    fit bezier curves to points added one by one.
+    points are smoothed in the same way as QgsGeometry.smooth() with one iteration.
+    curves ending farther than TAIL from the last point don't change any more, so they are committed
+    and only the points after them are kept and fitted again.
+    """
+    STEP = 8  # count of added points between fittings
+    TAIL = 16.0  # length of points fitted again, ratio to fitting distance
+    LIMIT = 200  # max count of kept points. a curve is committed over this even if it isn't finished
+
+    def __init__(self, point, maxError, maxIterations=4, cornerAngle=0.0, simplify=0.0):
+        self.maxError = maxError
+        self.maxIterations = maxIterations
+        self.cornerAngle = cornerAngle
+        self.simplify = simplify
+        self.count = 1  # count of added points
+        self._last = np.array(point, dtype=np.float64)
+        self._next = None  # smoothed point of the last segment, replaced by the last point at finish
+        self._points = [self._last]  # smoothed points not committed. the first one is the end of committed curves
+        self._tangent = None  # tangent of the end of committed curves
+        self._added = 0
+
+    def add(self, point):
+        """
+        add a point and return committed curves as (k, 4, 2) array
+        """
+        point = np.array(point, dtype=np.float64)
+        if (point == self._last).all():
+            return np.empty((0, 4, 2))
+        # corner cutting at 1/4 and 3/4 of each segment. the first and the last points are kept.
+        if self._next is not None:
+            self._points.append(self._next)
+            self._points.append(self._last + (point - self._last) * 0.25)
+        self._next = self._last + (point - self._last) * 0.75
+        self._last = point
+        self.count += 1
+        self._added += 1
+        if self._added < self.STEP:
+            return np.empty((0, 4, 2))
+        self._added = 0
+        return self._commit(False)
+
+    def finish(self):
+        """
+        fit the rest of points and return the last curves as (k, 4, 2) array
+        """
+        if self.count > 1:
+            self._points.append(self._last)
+        return self._commit(True)
+
+    def _commit(self, final):
+        points = np.array(self._points)
+        if len(points) < 2:
+            return np.empty((0, 4, 2))
+        fitPoints = points
+        if self.simplify > 0:
+            fitPoints = simplifyPoints(points, np.sqrt(self.maxError) * self.simplify)
+        beziers = fitCurve(fitPoints, self.maxError, self.maxIterations, self.cornerAngle, self._tangent)
+        if final:
+            return beziers
+
+        # the last curve isn't finished
+        d = np.diff(fitPoints, axis=0)
+        s = np.concatenate(([0.0], np.cumsum(np.sqrt((d * d).sum(axis=1)))))
+        ends = self._indices(fitPoints, beziers[:, 3])
+        count = int(np.count_nonzero(s[-1] - s[ends[:-1]] >= np.sqrt(self.maxError) * self.TAIL))
+        if count == 0:
+            # kept points don't reach LIMIT until the next fitting, 2 points are added by each point
+            if len(points) + 2 * self.STEP <= self.LIMIT:
+                return np.empty((0, 4, 2))
+            # long curve is split at the tail of kept points. at most half of LIMIT points are kept
+            d = np.diff(points, axis=0)
+            s = np.concatenate(([0.0], np.cumsum(np.sqrt((d * d).sum(axis=1)))))
+            last = int(np.searchsorted(s, s[-1] - np.sqrt(self.maxError) * self.TAIL))
+            last = int(np.clip(max(last, len(points) - self.LIMIT // 2), 1, len(points) - 2))
+            fitPoints = points[:last + 1]
+            if self.simplify > 0:
+                fitPoints = simplifyPoints(fitPoints, np.sqrt(self.maxError) * self.simplify)
+            beziers = fitCurve(fitPoints, self.maxError, self.maxIterations, self.cornerAngle, self._tangent)
+            count = len(beziers)
+            tangent = normalize(beziers[-1, 3] - beziers[-1, 2])
+        else:
+            # the next curve continues smoothly unless it is split at a corner
+            tangent = normalize(beziers[count - 1, 3] - beziers[count - 1, 2])
+            if np.dot(tangent, normalize(beziers[count, 1] - beziers[count, 0])) < 1.0 - 1.0e-9:
+                tangent = None
+        first = self._indices(points, beziers[count - 1:count, 3])[0]
+        del self._points[:first]
+        self._tangent = tangent
+        return beziers[:count]
+
+    @staticmethod
+    def _indices(points, ends):
+        # indices of curve ends in points, in order
+        indices = np.empty(len(ends), dtype=int)
+        i = 0
+        for k, end in enumerate(ends):
+            i += int(np.nonzero((points[i:] == end).all(axis=1))[0][0])
+            indices[k] = i
+        return indices
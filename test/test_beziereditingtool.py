@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+""""
+/***************************************************************************
+    BezierEditing
+     --------------------------------------
+    Date                 : 01 05 2019
+    Copyright            : (C) 2019 Takayuki Mizutani
+    Email                : mizutani at ecoris dot co dot jp
+ ***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+test of the map tool. it is skipped without QGIS. run it with python of QGIS from any directory:
+    python -m unittest discover -s test
+"""
+import importlib
+import os
+import sys
+import unittest
+
+try:
+    from qgis.gui import QgsMapCanvas
+    from qgis.testing import start_app
+except ImportError:
+    start_app = None
+
+plugin_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(plugin_dir))
+
+
+@unittest.skipIf(start_app is None, "QGIS isn't available")
+class BezierEditingToolTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        start_app()
+        cls.module = importlib.import_module(os.path.basename(plugin_dir) + ".beziereditingtool")
+
+    def test_create_tool(self):
+        canvas = QgsMapCanvas()
+        tool = self.module.BezierEditingTool(canvas, None)
+        interval = tool.frameInterval()
+        self.assertIsInstance(interval, int)
+        self.assertGreaterEqual(interval, 1)
+        self.assertEqual(tool.move_timer.interval(), interval)
+
+
+if __name__ == "__main__":
+    unittest.main()
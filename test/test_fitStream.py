@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+""""
+/***************************************************************************
+    BezierEditing
+     --------------------------------------
+    Date                 : 01 05 2019
+    Copyright            : (C) 2019 Takayuki Mizutani
+    Email                : mizutani at ecoris dot co dot jp
+ ***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+test of incremental curve fitting. run it with python of QGIS from any directory:
+    python -m unittest discover -s test
+"""
+import importlib
+import os
+import sys
+import unittest
+
+import numpy as np
+
+plugin_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(plugin_dir))
+fitStream = importlib.import_module(os.path.basename(plugin_dir) + ".fitStream")
+
+
+class StreamFitterTest(unittest.TestCase):
+
+    def draw(self, simplify):
+        fitter = fitStream.StreamFitter((0.0, 0.0), 1.0, simplify=simplify)
+        beziers = []
+        kept = 0
+        for i in range(1, 6001):
+            beziers.append(fitter.add((i * 0.5, 0.0)))
+            kept = max(kept, len(fitter._points))
+        beziers.append(fitter.finish())
+        return np.concatenate(beziers), kept
+
+    def test_long_straight_stroke(self):
+        for simplify in (0.0, 0.25):
+            beziers, kept = self.draw(simplify)
+            self.assertLessEqual(kept, fitStream.StreamFitter.LIMIT)
+            # curves are connected from the first point to the last point
+            np.testing.assert_array_equal(beziers[0, 0], (0.0, 0.0))
+            np.testing.assert_array_equal(beziers[-1, 3], (3000.0, 0.0))
+            np.testing.assert_array_equal(beziers[1:, 0], beziers[:-1, 3])
+
+
+if __name__ == "__main__":
+    unittest.main()